@@ -1,4 +1,4 @@
-
 from . import tregex
 from . import logger
-from . import simpletimer
\ No newline at end of file
+from . import simpletimer
+from . import tracer
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        bench_logger
+# Purpose:     Timing of the hot paths in the logger module.
+#
+#              python bench_logger.py [max_exponent]
+#
+#              Compiles logs of 10^3 up to 10^max_exponent messages (default
+#              6, use 7 for the full range) and prints the compile time per
+#              message. Linear compilation keeps the per message time flat.
+#              Also prints the memory cost per stored message, and the cost
+#              of a cached time stamp against a strftime call, and batch
+#              ingestion with Log.add_many against one call per message.
+#
+#              suite() gives the cases of run_benchmarks.py.
+#-------------------------------------------------------------------------------
+import sys
+import os
+import time
+import timeit
+import datetime
+import tracemalloc
+import tempfile
+import shutil
+
+sys.path = [os.path.split(os.path.split(os.path.realpath(__file__))[0])[0] + os.path.sep] + sys.path
+
+import logger
+
+
+def build_log(count):
+    log = logger.Log()
+    for i in range(count):
+        if i % 100 == 0:
+            log.addError('Error nr %d' % i)
+        else:
+            log.addMessage('Message nr %d' % i)
+    return log
+
+
+def bench_compile(count, repeat=3):
+    """Return the best time in seconds for compiling a log of count messages."""
+    log = build_log(count)
+    return min(timeit.repeat(lambda: log.returnLogAsString(), number=1, repeat=repeat))
+
+
+def bench_memory(count=100000, unique=1000):
+    """Return the traced bytes per message added to a log, with unique distinct texts."""
+    tracemalloc.start()
+    try:
+        log = logger.Log()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(count):
+            log.addMessage('Message nr %d' % (i % unique))
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count
+
+
+def bench_timestamp(count=100000, per_second=1000):
+    """Return nanoseconds per stamp for strftime and for the timestamp cache, with per_second stamps sharing each
+    second."""
+    start = time.time()
+    epochs = [start + i / per_second for i in range(count)]
+    fromtimestamp = datetime.datetime.fromtimestamp
+    cache = logger.TimestampCache()
+
+    strftime_time = min(timeit.repeat(
+        lambda: [fromtimestamp(epoch).strftime('%Y.%m.%d %H:%M:%S') for epoch in epochs], number=1, repeat=3))
+    cache_time = min(timeit.repeat(lambda: [cache.stamp(epoch) for epoch in epochs], number=1, repeat=3))
+    return strftime_time / count * 1e9, cache_time / count * 1e9
+
+
+def bench_add_many(count=100000, repeat=3):
+    """Return nanoseconds per message for addMessage/addError per message and for one Log.add_many call."""
+    texts = ['Message nr %d' % i for i in range(count)]
+    levels = ['error' if i % 100 == 0 else 'message' for i in range(count)]
+
+    def single():
+        log = logger.Log()
+        for text, level in zip(texts, levels):
+            if level == 'error':
+                log.addError(text)
+            else:
+                log.addMessage(text)
+
+    def batch():
+        logger.Log().add_many(texts, level=levels)
+
+    single_time = min(timeit.repeat(single, number=1, repeat=repeat))
+    batch_time = min(timeit.repeat(batch, number=1, repeat=repeat))
+    return single_time / count * 1e9, batch_time / count * 1e9
+
+
+def suite(sizes):
+    """Return the (name, size, count, make) cases of the logger hot paths for run_benchmarks. make() prepares a case
+    and returns a function that performs count operations."""
+    cases = []
+    for size in sizes:
+        def add_message(size=size):
+            def add():
+                log = logger.Log()
+                for i in range(size):
+                    log.addMessage('Message nr %d' % i)
+            return add
+
+        def add_many(size=size):
+            texts = ['Message nr %d' % i for i in range(size)]
+            return lambda: logger.Log().add_many(texts)
+
+        def compile_text(size=size):
+            log = build_log(size)
+            return lambda: log._compileLogText_('Log')
+
+        def print_to_file(size=size):
+            log = build_log(size)
+            path = tempfile.mkdtemp()
+
+            def write():
+                try:
+                    log.printLogToFile(path, 'bench.txt', completeName=True)
+                finally:
+                    os.remove(log.log_file_path)
+            write.cleanup = lambda: shutil.rmtree(path)
+            return write
+
+        cases += [('Log.addMessage', size, size, add_message), ('Log.add_many', size, size, add_many),
+                  ('Log._compileLogText_', size, size, compile_text), ('Log.printLogToFile', size, size, print_to_file)]
+    return cases
+
+
+def run(max_exponent=6):
+    print('Memory per message: %.1f bytes' % bench_memory())
+    print('Adding: one by one %.1f ns, add_many %.1f ns per message' % bench_add_many())
+    print('Time stamp: strftime %.1f ns, cached %.1f ns' % bench_timestamp())
+    print('%10s %12s %14s' % ('messages', 'compile [s]', 'per msg [ns]'))
+    for exponent in range(3, max_exponent + 1):
+        count = 10 ** exponent
+        seconds = bench_compile(count, repeat=3 if exponent < 6 else 1)
+        print('%10d %12.4f %14.1f' % (count, seconds, seconds / count * 1e9))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 6)
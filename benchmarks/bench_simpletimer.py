@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        bench_simpletimer
+# Purpose:     Timing of the hot paths in the simpletimer module.
+#
+#              python bench_simpletimer.py
+#
+#              Prints the per item overhead of ProgressTimer.wrap against a
+#              bare loop, when no render is due, and the overhead of the
+#              SlowIterationSampler on a busy loop.
+#
+#              suite() gives the cases of run_benchmarks.py.
+#-------------------------------------------------------------------------------
+import sys
+import os
+import io
+import time
+import timeit
+
+sys.path = [os.path.split(os.path.split(os.path.realpath(__file__))[0])[0] + os.path.sep] + sys.path
+
+import simpletimer
+import logger
+
+
+def bench_wrap(count=1000000, repeat=5):
+    """Return the added nanoseconds per item of ProgressTimer.wrap over a bare loop, when no render is due."""
+    items = range(count)
+
+    def bare():
+        for item in items:
+            pass
+
+    def wrapped():
+        timer = simpletimer.ProgressTimer(count)
+        for item in timer.wrap(items, min_interval=3600, file=io.StringIO()):
+            pass
+
+    bare_time = min(timeit.repeat(bare, number=1, repeat=repeat))
+    wrapped_time = min(timeit.repeat(wrapped, number=1, repeat=repeat))
+    return (wrapped_time - bare_time)/count*1e9
+
+
+def bench_sampler(seconds=2.0, interval=0.001):
+    """Return the fractional slowdown of a busy loop with a SlowIterationSampler attached, and the sampler's own
+    measure of its overhead."""
+    def loop(timer):
+        count = 0
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            sum(range(100))
+            timer.calculate()
+            count += 1
+        return count
+
+    bare = loop(simpletimer.ProgressTimer(10**9))
+    timer = simpletimer.ProgressTimer(10**9)
+    with timer.attach_sampler(logger.Log(), interval=interval) as sampler:
+        sampled = loop(timer)
+    return 1 - sampled/bare, sampler.overhead_fraction
+
+
+def suite(sizes, sample_sizes, sample_calls=100000):
+    """Return the (name, size, count, make) cases of the simpletimer hot paths for run_benchmarks. make() prepares a
+    case and returns a function that performs count operations."""
+    cases = []
+    for size in sizes:
+        def calculate(size=size):
+            def loop():
+                timer = simpletimer.ProgressTimer(size)
+                for i in range(size):
+                    timer.calculate()
+            return loop
+
+        def string(size=size):
+            def loop():
+                timer = simpletimer.ProgressTimer(size)
+                for i in range(size):
+                    timer.string()
+            return loop
+
+        def simple_time(size=size):
+            def loop():
+                timer = simpletimer.SimpleTimer()
+                for i in range(size):
+                    timer.time()
+            return loop
+
+        cases += [('ProgressTimer.calculate', size, size, calculate), ('ProgressTimer.string', size, size, string),
+                  ('SimpleTimer.time', size, size, simple_time)]
+
+    for sample_size in sample_sizes:
+        def calculate_sample(sample_size=sample_size):
+            def loop():
+                timer = simpletimer.ProgressTimer(10*max(sample_calls, sample_size), sample_size=sample_size)
+                for i in range(sample_calls):
+                    timer.calculate_sample(None)
+            return loop
+
+        cases.append(('ProgressTimer.calculate_sample', sample_size, sample_calls, calculate_sample))
+    return cases
+
+
+def run():
+    print('ProgressTimer.wrap overhead: %.1f ns per item' % bench_wrap())
+    slowdown, overhead = bench_sampler()
+    print('SlowIterationSampler: %.1f %% slowdown, %.2f %% measured sampling overhead' % (100*slowdown,
+                                                                                          100*overhead))
+
+
+if __name__ == '__main__':
+    run()
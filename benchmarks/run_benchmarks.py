@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        run_benchmarks
+# Purpose:     Benchmark suite of the logger and simpletimer hot paths, with
+#              JSON baselines and a regression check.
+#
+#              python run_benchmarks.py [--max-exponent 5] [--save]
+#                                       [--baseline baseline.json]
+#                                       [--tolerance 20] [--filter Log.]
+#
+#              Runs the cases of bench_logger.suite and bench_simpletimer.suite
+#              over input sizes 10^3 to 10^max_exponent (7 for the full range)
+#              and sample sizes 10 to 10^max_sample_exponent. Prints the best
+#              time, the time per operation and the peak memory traced by
+#              tracemalloc of each case.
+#
+#              --save writes the results as the baseline. Otherwise the
+#              results are compared with the baseline, if it exists, and the
+#              exit status is 1 when a case is more than tolerance percent
+#              slower or uses more than tolerance percent more memory.
+#              Baselines are machine specific and are not kept in the
+#              repository.
+#-------------------------------------------------------------------------------
+import sys
+import os
+import gc
+import json
+import timeit
+import platform
+import argparse
+import tracemalloc
+
+sys.path = [os.path.split(os.path.split(os.path.realpath(__file__))[0])[0] + os.path.sep] + sys.path
+
+import bench_logger
+import bench_simpletimer
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baseline.json')
+METRICS = ('ns_per_op', 'peak_bytes')
+
+
+def measure(make, count, repeat=3):
+    """Return the best seconds, nanoseconds per operation and peak traced bytes of the function made by make."""
+    function = make()
+    try:
+        gc.collect()
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+        # Memory is traced in a separate run, since tracing slows everything down:
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        cleanup = getattr(function, 'cleanup', None)
+        if cleanup is not None:
+            cleanup()
+    return {'seconds': seconds, 'ns_per_op': seconds/count*1e9, 'peak_bytes': peak}
+
+
+def run_suite(max_exponent=5, max_sample_exponent=6, repeat=3, filter=None, file=sys.stdout):
+    """Run the benchmark cases and return the results by case name, 'name[size]'."""
+    sizes = [10**exponent for exponent in range(3, max_exponent + 1)]
+    sample_sizes = [10**exponent for exponent in range(1, max_sample_exponent + 1)]
+    cases = bench_logger.suite(sizes) + bench_simpletimer.suite(sizes, sample_sizes)
+
+    results = {}
+    file.write('%-40s %12s %12s %14s\n' % ('case', 'best [s]', 'per op [ns]', 'peak [bytes]'))
+    for name, size, count, make in cases:
+        key = '%s[%d]' % (name, size)
+        if filter and filter not in key:
+            continue
+        result = results[key] = measure(make, count, repeat if size < 10**6 else 1)
+        file.write('%-40s %12.4f %12.1f %14d\n' % (key, result['seconds'], result['ns_per_op'], result['peak_bytes']))
+        file.flush()
+    return results
+
+
+def compare(results, baseline, tolerance=20.0):
+    """Return descriptions of the results that exceed the baseline results by more than tolerance percent."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        for metric in METRICS:
+            if reference[metric] > 0 and result[metric] > reference[metric]*(1 + tolerance/100):
+                regressions.append('%s %s: %.1f against baseline %.1f (+%.0f %%)' % (
+                    key, metric, result[metric], reference[metric], 100*(result[metric]/reference[metric] - 1)))
+    return regressions
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results}, f,
+                  indent=1, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def run(argv=None):
+    """Run the suite from the command line arguments argv and return the exit status."""
+    parser = argparse.ArgumentParser(description='Benchmarks of the logger and simpletimer hot paths.')
+    parser.add_argument('--max-exponent', type=int, default=5, help='Largest input size as a power of 10.')
+    parser.add_argument('--max-sample-exponent', type=int, default=6, help='Largest sample size as a power of 10.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing runs per case, the best is kept.')
+    parser.add_argument('--filter', help='Only run cases whose name contains this text.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Path of the JSON baseline.')
+    parser.add_argument('--save', action='store_true', help='Save the results as the baseline.')
+    parser.add_argument('--tolerance', type=float, default=20.0, help='Allowed regression in percent.')
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.max_exponent, args.max_sample_exponent, args.repeat, args.filter)
+    if args.save:
+        save(results, args.baseline)
+        print('Baseline saved to %s' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, run with --save to create one.' % args.baseline)
+        return 0
+
+    regressions = compare(results, load(args.baseline), args.tolerance)
+    for regression in regressions:
+        print('Regression: %s' % regression)
+    if regressions:
+        return 1
+    print('No regressions beyond %.0f %%.' % args.tolerance)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -29,62 +29,1465 @@ Copyright:   (c) tobiasl 2014
 import datetime as time
 import os
 import smtplib
-##from email.MIMEMultipart import MIMEMultipart
-##from email.MIMEBase import MIMEBase
-##from email.MIMEText import MIMEText
-##from email import Encoders
-##from email.Utils import formatdate
+import sys
+import gzip
+import bz2
+import lzma
+import shutil
+import json
+import mmap
+from bisect import bisect_left, bisect_right
+import heapq
+import threading
+import multiprocessing
+from multiprocessing.util import Finalize
+from array import array
+from collections import deque
+from queue import Empty, Queue
+from time import time as epochTime, localtime, strftime
+from timeit import default_timer
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+import base64
+import mimetypes
+from email.header import Header
+from email.utils import formatdate, make_msgid
+
+# Bit flags of a stored message, see MessageStore:
+TIMESTAMP = 1
+NEWLINE = 2
+ERROR = 4
+WARNING = 8
+
+
+class TimestampCache(object):
+    # Cache of formatted time stamps, keyed by whole epoch second. Log
+    # messages arrive many to a second, so almost every stamp is a dictionary
+    # lookup instead of a strftime call. When maxSize seconds are cached, the
+    # oldest entry is evicted.
+    #
+    # The cache is shared by the writer, collector and sampler threads. Hits
+    # are a plain lookup, and misses update the cache under a lock.
+
+    def __init__(self, maxSize=1024, format='%Y.%m.%d %H:%M:%S'):
+        self.maxSize = maxSize
+        self.format = format
+        self._stamps_ = {}
+        self._lock_ = threading.Lock()
+
+    def stamp(self, epoch):
+        # Return the formatted local time of epoch seconds. Rounds to
+        # microseconds first, like datetime.fromtimestamp.
+        second = int(epoch + 5e-7)
+        try:
+            return self._stamps_[second]
+        except KeyError:
+            pass
+        stamp = strftime(self.format, localtime(second))
+        stamps = self._stamps_
+        with self._lock_:
+            while len(stamps) >= self.maxSize:
+                del stamps[next(iter(stamps))]
+            stamps[second] = stamp
+        return stamp
+
+
+_timestampCache = TimestampCache()
+
+
+def _compileLine_(text, stamp, newline, error, warning):
+    #Creates a ready formatted print string from the parts of a message.
+    assert not (error and warning)
+    line = ''
+    if newline: line = '\n'
+    if stamp: stamp = '%s-' % stamp
+    label = ''
+    if error: label = 'Error: '
+    if warning: label = 'Warning: '
+
+    return '%s%s%s%s' % (line, stamp, label, text)
+
 
 class Message(object):
     # Message object that contains all information regarding messages for a
     # single point in time. Can contain any number of individual messages for the
     # same time stamp. Contains both messages and errors in the same list,
     # separated by the error = True/False value.
+    #
+    # Messages kept by a Log are stored in a MessageStore, and Message objects
+    # are only created as light views when a stored message is accessed. The
+    # time is kept as epoch seconds and only turned into a datetime when the
+    # time attribute is read.
+
+    __slots__ = ('epoch', 'text', 'timestamp', 'newline', 'error', 'warning')
 
     def __init__(self, text, timestamp=True, newline=True, error=False, warning=False):
-        self.time = time.datetime.now()
+        self.epoch = epochTime()
         self.text = text
         self.timestamp = timestamp
         self.newline = newline
         self.error = error
         self.warning = warning
 
+    @classmethod
+    def fromRecord(cls, epoch, text, flags):
+        #Create a Message from a stored record of epoch seconds, text and bit
+        #flags.
+        message = cls.__new__(cls)
+        message.epoch = epoch
+        message.text = text
+        message.timestamp = bool(flags & TIMESTAMP)
+        message.newline = bool(flags & NEWLINE)
+        message.error = bool(flags & ERROR)
+        message.warning = bool(flags & WARNING)
+        return message
+
+    @property
+    def time(self):
+        return time.datetime.fromtimestamp(self.epoch)
+
+    @time.setter
+    def time(self, value):
+        self.epoch = value.timestamp()
+
+    def flags(self):
+        #Return the bit flags of the message.
+        return ((TIMESTAMP if self.timestamp else 0) | (NEWLINE if self.newline else 0) |
+                (ERROR if self.error else 0) | (WARNING if self.warning else 0))
+
     def getMessage(self, newline=None):
         #Returns all text in message object as one ready formatted string.
         #The newline argument can override the newline of the message object.
-        message = ''
+        if isinstance(self.text,list):
+           return ''.join(self.iterMessage(newline))
+        return self._compile_(self.text, newline)
+
+    def iterMessage(self, newline=None):
+        #Yields the ready formatted string of each text in the message object.
         if isinstance(self.text,list):
            for text in self.text:
-               message += self._compile_(text, newline)
+               yield self._compile_(text, newline)
         else:
-             message += self._compile_(self.text, newline)
-        return message
+             yield self._compile_(self.text, newline)
 
     def _compile_(self, text, newline=None):
         #Creates a ready formatted print string.
         #text = unicode(text, "UTF-8")
         stamp = ''
-        if self.timestamp: stamp = '%s-' % self.time.strftime('%Y.%m.%d %H:%M:%S')
-
-        line = ''
+        if self.timestamp: stamp = _timestampCache.stamp(self.epoch)
 
         if isinstance(newline,type(None)):
             newline = self.newline
-        if newline: line = '\n'
 
-        assert not (self.error and self.warning)
-        label = ''
-        if self.error: label = 'Error: '
-        if self.warning: label = 'Warning: '
+        return _compileLine_(text, stamp, newline, self.error, self.warning)
+
+
+class MessageStore(object):
+    # Compact columnar storage for the messages of a Log. Time stamps are kept
+    # as epoch seconds in an array of doubles, the timestamp, newline, error
+    # and warning flags packed in a bytearray, and texts in a list of interned
+    # strings. Costs a few bytes per message on top of the text itself, instead
+    # of a full Message object and datetime.
+    #
+    # Behaves like the list of Message objects it replaces. Indexing and
+    # iteration return Message views of the stored records.
+    #
+    # The positions of errors and warnings are kept in index arrays as they
+    # are added. Together with bisection over the time stamps, which are
+    # kept in time order, this answers queries by level and time in
+    # O(log n + k).
+
+    pending = ()  #Repeats not yet written, see BoundedMessageStore.
+
+    def __init__(self):
+        self.times = array('d')
+        self.flags = bytearray()
+        self.texts = []
+        self.errorIndex = array('q')
+        self.warningIndex = array('q')
+
+    def add(self, epoch, text, flags):
+        #Store a single message record. Times are kept in order for the
+        #queries, so a record older than the last one, as from a thread that
+        #was overtaken by another or a worker collected late, is inserted at
+        #its place with its own epoch.
+        if type(text) is str:
+            text = sys.intern(text)
+        times = self.times
+        if times and epoch < times[-1]:
+            self._insert_(epoch, text, flags)
+            return
+        if flags & ERROR:
+            self.errorIndex.append(len(self.texts))
+        elif flags & WARNING:
+            self.warningIndex.append(len(self.texts))
+        self.times.append(epoch)
+        self.flags.append(flags)
+        self.texts.append(text)
+
+    def addMany(self, epoch, texts, flags):
+        #Store a batch of messages with the same epoch. flags is a bytes-like
+        #object with the flags of each text.
+        start = len(self.texts)
+        intern = sys.intern
+        if self.times and epoch < self.times[-1]:
+            for text, value in zip(texts, flags):
+                self._insert_(epoch, intern(text) if type(text) is str else text, value)
+            return
+        self.times.extend(array('d', [epoch]) * len(texts))
+        self.flags.extend(flags)
+        self.texts.extend([intern(text) if type(text) is str else text for text in texts])
+        levels = set(flags)
+        if any(value & ERROR for value in levels):
+            self.errorIndex.extend([start + i for i, value in enumerate(flags) if value & ERROR])
+        if any(value & WARNING for value in levels):
+            self.warningIndex.extend([start + i for i, value in enumerate(flags) if value & WARNING])
+
+    def _insert_(self, epoch, text, flags):
+        #Insert a record older than the last one after the records with the
+        #same or an earlier epoch, and move the positions in the level
+        #indices behind it up by one. Costs O(n - position).
+        position = bisect_right(self.times, epoch)
+        for index in (self.errorIndex, self.warningIndex):
+            start = bisect_left(index, position)
+            if start < len(index):
+                index[start:] = array('q', [i + 1 for i in index[start:]])
+        if flags & ERROR:
+            self.errorIndex.insert(bisect_left(self.errorIndex, position), position)
+        elif flags & WARNING:
+            self.warningIndex.insert(bisect_left(self.warningIndex, position), position)
+        self.times.insert(position, epoch)
+        self.flags.insert(position, flags)
+        self.texts.insert(position, text)
+
+    def append(self, message):
+        #Store a Message object.
+        self.add(message.epoch, message.text, message.flags())
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def records(self):
+        #Iterate over the stored (epoch, text, flags) records without
+        #creating Message objects.
+        return zip(self.times, self.texts, self.flags)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return Message.fromRecord(self.times[index], self.texts[index], self.flags[index])
+
+    def __iter__(self):
+        for epoch, text, flags in self.records():
+            yield Message.fromRecord(epoch, text, flags)
+
+    def span(self, since=None, until=None):
+        #Return the index range [first, last) of messages from since to
+        #until epoch seconds, inclusive.
+        first = 0 if since is None else bisect_left(self.times, since)
+        last = len(self.times) if until is None else bisect_right(self.times, until)
+        return first, last
+
+    def _levelIndex_(self, level):
+        return self.errorIndex if level == 'error' else self.warningIndex
+
+    def indices(self, level=None, since=None, until=None):
+        #Return the positions of messages of level ('message', 'warning',
+        #'error' or None for all) from since to until epoch seconds.
+        first, last = self.span(since, until)
+        if level is None:
+            return range(first, last)
+        if level == 'message':
+            flags = self.flags
+            return [i for i in range(first, last) if not flags[i] & (ERROR | WARNING)]
+        index = self._levelIndex_(level)
+        return index[bisect_left(index, first):bisect_left(index, last)]
+
+    def count(self, level=None, since=None, until=None):
+        #Number of messages of level from since to until epoch seconds.
+        first, last = self.span(since, until)
+        if level is None or level == 'message':
+            count = last - first
+            if level == 'message':
+                count -= self.count('error', since, until) + self.count('warning', since, until)
+            return count
+        index = self._levelIndex_(level)
+        return bisect_left(index, last) - bisect_left(index, first)
+
+    def last(self, n, level=None):
+        #Positions of the last n messages of level, oldest first.
+        if n <= 0:
+            return []
+        if level in ('error', 'warning'):
+            return list(self._levelIndex_(level)[-n:])
+        if level is None:
+            return list(range(max(len(self) - n, 0), len(self)))
+        flags, found = self.flags, []
+        for i in range(len(self) - 1, -1, -1):
+            if not flags[i] & (ERROR | WARNING):
+                found.append(i)
+                if len(found) >= n:
+                    break
+        return found[::-1]
+
+
+class BoundedMessageStore(object):
+    # Message store of fixed size for long runs and error storms. Keeps the
+    # last maxMessages plain messages, and errors and warnings in a separate
+    # ring of the last maxLevelMessages, so a flood of messages does not push
+    # out the errors. Messages that fall out of a ring are counted in dropped.
+    #
+    # A message with the same text and level as the last message, or as any
+    # kept message first seen less than dedupWindow seconds ago, is collapsed
+    # into that entry. The entry keeps the number of repeats and the time of
+    # the last one, and its text is written with the repeat count appended.
+    # Collapsed messages are counted in collapsed, and suppressed is the sum
+    # of collapsed and dropped. Repeats are reported to sinks with one
+    # message per entry when its window has passed, or when another message
+    # arrives if only consecutive messages are collapsed, see takeRepeats.
+    #
+    # Has the query interface of MessageStore. Queries scan the kept entries,
+    # which are at most maxMessages + maxLevelMessages.
+
+    def __init__(self, maxMessages, maxLevelMessages=None, dedupWindow=None):
+        # Input:
+        #       maxMessages     int, Number of plain messages kept.
+        #       maxLevelMessages int, Number of errors and warnings kept.
+        #                            Defaults to maxMessages.
+        #       dedupWindow     float, Seconds within which identical
+        #                              messages are collapsed. None only
+        #                              collapses consecutive messages.
+        if maxLevelMessages is None:
+            maxLevelMessages = maxMessages
+        self.messages = deque(maxlen=maxMessages)
+        self.levelled = deque(maxlen=maxLevelMessages)
+        self.dedupWindow = dedupWindow
+        self.collapsed = 0
+        self.dropped = 0
+        self.pending = []  #Entries with repeats not yet written to sinks.
+        self._due_ = float('inf')
+        self._recent_ = {}
+        self._last_ = None
+        self._entries_ = None
+
+    @property
+    def suppressed(self):
+        return self.collapsed + self.dropped
+
+    def add(self, epoch, text, flags):
+        #Store a single message record. Returns True if it was collapsed into
+        #an earlier entry. An entry is the list [epoch, text, flags, repeats,
+        #last epoch, repeats not yet written].
+        key = (text, flags) if type(text) is str else None
+        if key is not None:
+            if self.dedupWindow is None:
+                entry = self._last_
+                if entry is not None and (entry[1] != text or entry[2] != flags):
+                    entry = None
+            else:
+                entry = self._recent_.get(key)
+                if entry is not None and epoch - entry[0] > self.dedupWindow:
+                    entry = None
+            if entry is not None:
+                entry[3] += 1
+                entry[4] = epoch
+                if not entry[5]:
+                    self.pending.append(entry)
+                    if self.dedupWindow is not None:
+                        self._due_ = min(self._due_, entry[0] + self.dedupWindow)
+                entry[5] += 1
+                self.collapsed += 1
+                return True
+            text = sys.intern(text)
+
+        entry = [epoch, text, flags, 0, epoch, 0]
+        ring = self.levelled if flags & (ERROR | WARNING) else self.messages
+        if len(ring) == ring.maxlen:
+            old = ring.popleft()
+            self.dropped += 1
+            if type(old[1]) is str and self._recent_.get((old[1], old[2])) is old:
+                del self._recent_[(old[1], old[2])]
+        if ring and epoch < ring[-1][0]:
+            #Older than the last entry, inserted at its place, see MessageStore.add.
+            position = len(ring) - 1
+            while position and epoch < ring[position - 1][0]:
+                position -= 1
+            ring.insert(position, entry)
+        else:
+            ring.append(entry)
+        self._last_ = entry
+        if key is not None and self.dedupWindow is not None:
+            self._recent_[key] = entry
+        self._entries_ = None
+        return False
+
+    def append(self, message):
+        #Store a Message object.
+        self.add(message.epoch, message.text, message.flags())
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def repeatsDue(self, epoch):
+        #True if takeRepeats(epoch) has repeats to report.
+        return bool(self.pending) and (self.dedupWindow is None or epoch > self._due_)
+
+    def takeRepeats(self, epoch=None):
+        #Return (epoch, text, flags) records that report the repeats not yet
+        #reported, one per entry, for entries whose window has passed at
+        #epoch. None takes all.
+        if epoch is None or self.dedupWindow is None:
+            due, self.pending = self.pending, []
+        else:
+            limit = epoch - self.dedupWindow
+            due = [entry for entry in self.pending if entry[0] < limit]
+            self.pending = [entry for entry in self.pending if entry[0] >= limit]
+        self._due_ = min([entry[0] + self.dedupWindow for entry in self.pending] or [float('inf')])
+        records = []
+        for entry in due:
+            records.append((entry[4], '%s [repeated %d more times]' % (entry[1], entry[5]), entry[2]))
+            entry[5] = 0
+        return records
+
+    def entries(self):
+        #Kept entries of both rings, in time order.
+        if self._entries_ is None:
+            self._entries_ = list(heapq.merge(self.messages, self.levelled, key=lambda entry: entry[0]))
+        return self._entries_
+
+    @staticmethod
+    def _text_(entry):
+        if entry[3]:
+            return '%s [repeated %d times, last at %s]' % (entry[1], entry[3] + 1, _timestampCache.stamp(entry[4]))
+        return entry[1]
+
+    def records(self):
+        #Iterate over the kept (epoch, text, flags) records. Collapsed entries
+        #have the repeat count appended to the text.
+        text = self._text_
+        for entry in self.entries():
+            yield entry[0], text(entry), entry[2]
+
+    def __len__(self):
+        return len(self.messages) + len(self.levelled)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        entry = self.entries()[index]
+        return Message.fromRecord(entry[0], self._text_(entry), entry[2])
+
+    def __iter__(self):
+        for epoch, text, flags in self.records():
+            yield Message.fromRecord(epoch, text, flags)
+
+    def span(self, since=None, until=None):
+        #Return the index range [first, last) of entries first seen from
+        #since to until epoch seconds, inclusive.
+        times = [entry[0] for entry in self.entries()]
+        first = 0 if since is None else bisect_left(times, since)
+        last = len(times) if until is None else bisect_right(times, until)
+        return first, last
+
+    def indices(self, level=None, since=None, until=None):
+        #Return the positions of entries of level, see MessageStore.
+        first, last = self.span(since, until)
+        entries = self.entries()
+        return [i for i in range(first, last) if _isLevel_(entries[i][2], level)]
+
+    def count(self, level=None, since=None, until=None):
+        #Number of kept messages of level from since to until epoch seconds,
+        #repeats included.
+        entries = self.entries()
+        return sum(entries[i][3] + 1 for i in self.indices(level, since, until))
+
+    def last(self, n, level=None):
+        #Positions of the last n entries of level, oldest first.
+        if n <= 0:
+            return []
+        return self.indices(level)[-n:]
+
+
+class FlushTimer(object):
+    # Background thread that flushes a sink with messages waiting when
+    # interval seconds have passed since its last flush, so the time based
+    # flush policy also holds when the log goes quiet. The sink provides
+    # _lock_, _pending_, _lastFlush_ and flush().
+
+    def __init__(self, sink, interval):
+        self.sink = sink
+        self.interval = interval
+        self._stop_ = threading.Event()
+        self.thread = threading.Thread(target=self._run_, name='LogFlush', daemon=True)
+        self.thread.start()
+
+    def _run_(self):
+        sink = self.sink
+        while not self._stop_.wait(self.interval):
+            with sink._lock_:
+                if sink._pending_ and not sink.file.closed and default_timer() - sink._lastFlush_ >= self.interval:
+                    sink.flush()
+
+    def cancel(self):
+        self._stop_.set()
+        self.thread.join()
+
+
+class FileSink(object):
+    # Write-through sink for a Log. Opens the log file at creation and appends
+    # every formatted message through a buffered writer as it is added, so the
+    # log lives on disk instead of in memory and survives a crash up to the
+    # last flush.
+    #
+    # The time based flush policy is checked when messages are written, and
+    # by a FlushTimer while the log is quiet.
+
+    def __init__(self, filePath, bufferSize=65536, flushCount=None, flushInterval=None, flushOnError=True):
+        # Input:
+        #       filePath        string, Full path of the log file.
+        #       bufferSize      int, Size of the write buffer in bytes.
+        #       flushCount      int, Flush every flushCount messages. None
+        #                            disables count based flushing.
+        #       flushInterval   int, Flush when flushInterval milliseconds have
+        #                            passed since the last flush. None disables
+        #                            time based flushing.
+        #       flushOnError    boolean, Flush as soon as an error is written.
+
+        self.filePath = filePath
+        self.flushCount = flushCount
+        self.flushInterval = flushInterval
+        self.flushOnError = flushOnError
+        self.bufferSize = bufferSize
+        self.file = open(filePath, 'w', buffering=bufferSize)
+        self._pending_ = 0
+        self._lastFlush_ = default_timer()
+        self._lock_ = threading.RLock()
+        self._timer_ = None
+        if flushInterval is not None:
+            self._timer_ = FlushTimer(self, flushInterval / 1000)
+
+    def open(self, log, title):
+        # Write the log header. Called by the Log when the sink is attached.
+        self.file.write(log._logHeader_(title))
+
+    def write(self, message):
+        # Append a single Message to the file and apply the flush policy.
+        # Writes only take the sink lock when a FlushTimer may flush at the
+        # same time.
+        if self._timer_ is None:
+            self._write_(message)
+        else:
+            with self._lock_:
+                self._write_(message)
+
+    def _write_(self, message):
+        self.file.write(message.getMessage())
+        self._written_(message)
+
+    def _written_(self, message):
+        # Apply the flush policy after message was written.
+        self._pending_ += 1
+
+        if self.flushOnError and message.error:
+            self.flush()
+        elif self.flushCount and self._pending_ >= self.flushCount:
+            self.flush()
+        elif self.flushInterval is not None:
+            if (default_timer() - self._lastFlush_) * 1000 >= self.flushInterval:
+                self.flush()
+
+    def flush(self):
+        # Push buffered messages to disk.
+        with self._lock_:
+            self.file.flush()
+            self._pending_ = 0
+            self._lastFlush_ = default_timer()
+
+    def close(self, log):
+        # Write the summary footer and close the file.
+        if self._timer_ is not None:
+            self._timer_.cancel()
+            self._timer_ = None
+        with self._lock_:
+            if self.file.closed:
+                return
+            try:
+                self.file.write(log._logFooter_())
+            finally:
+                self.file.close()
+
+
+class StructuredSink(object):
+    # Sink writing the log as JSON lines, for LogReader. The first line holds
+    # the title and start time of the log, and every following line one
+    # message as [epoch, flags, text]. Flags are the bit flags of
+    # MessageStore.
+    #
+    # On close, a side index is written to filePath + '.idx'. It splits the
+    # file into blocks of blockSize messages and stores the first time stamp,
+    # byte offset and message, warning and error counts of each block, so
+    # queries only read the blocks that can contain what they ask for.
+
+    def __init__(self, filePath, blockSize=1024, bufferSize=65536, flushCount=None, flushInterval=None,
+                 flushOnError=True):
+        # Input:
+        #       filePath        string, Full path of the log file.
+        #       blockSize       int, Messages per index block.
+        #       bufferSize, flushCount, flushInterval, flushOnError
+        #                       Flush policy. See FileSink.
+        self.filePath = filePath
+        self.blockSize = blockSize
+        self.flushCount = flushCount
+        self.flushInterval = flushInterval
+        self.flushOnError = flushOnError
+        self.file = open(filePath, 'wb', buffering=bufferSize)
+        self.offset = 0
+        self.blocks = []
+        self._pending_ = 0
+        self._lastFlush_ = default_timer()
+        self._lock_ = threading.RLock()
+        self._timer_ = None
+        if flushInterval is not None:
+            self._timer_ = FlushTimer(self, flushInterval / 1000)
+
+    def open(self, log, title):
+        self._writeLine_({'title': title, 'init': log.init.timestamp()})
+
+    def write(self, message):
+        self.writeRecord(message.epoch, message.text, message.flags())
+
+    def writeRecord(self, epoch, text, flags):
+        # Write a single message record. See FileSink.write for the lock.
+        if self._timer_ is None:
+            self._writeRecord_(epoch, text, flags)
+        else:
+            with self._lock_:
+                self._writeRecord_(epoch, text, flags)
+
+    def _writeRecord_(self, epoch, text, flags):
+        blocks = self.blocks
+        if not blocks or blocks[-1][2] >= self.blockSize:
+            blocks.append([epoch, self.offset, 0, 0, 0])
+        block = blocks[-1]
+        block[2] += 1
+        if flags & WARNING:
+            block[3] += 1
+        elif flags & ERROR:
+            block[4] += 1
+        self._writeLine_([epoch, flags, text])
+
+        self._pending_ += 1
+        if self.flushOnError and flags & ERROR:
+            self.flush()
+        elif self.flushCount and self._pending_ >= self.flushCount:
+            self.flush()
+        elif self.flushInterval is not None:
+            if (default_timer() - self._lastFlush_) * 1000 >= self.flushInterval:
+                self.flush()
+
+    def _writeLine_(self, value):
+        line = (json.dumps(value, ensure_ascii=False) + '\n').encode('utf-8')
+        self.file.write(line)
+        self.offset += len(line)
+
+    def flush(self):
+        with self._lock_:
+            self.file.flush()
+            self._pending_ = 0
+            self._lastFlush_ = default_timer()
+
+    def close(self, log):
+        # Close the file and write the index.
+        if self._timer_ is not None:
+            self._timer_.cancel()
+            self._timer_ = None
+        with self._lock_:
+            if self.file.closed:
+                return
+            self.file.close()
+        with open(self.filePath + '.idx', 'w') as f:
+            json.dump({'blockSize': self.blockSize, 'end': self.offset, 'blocks': self.blocks}, f)
+
+
+class LogReader(object):
+    # Reader for logs written by StructuredSink. The file is memory mapped
+    # and queries use the side index to read only the blocks that can hold
+    # matching messages. Without an index, or for messages written after it,
+    # the index is rebuilt by one scan of the missing part.
+    #
+    # Times are given as datetime or epoch seconds. Query results are Message
+    # objects, oldest first.
+
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.file = open(filePath, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        end = self.map.find(b'\n')
+        meta = json.loads(self.map[:end])
+        self.title = meta['title']
+        self.init = time.datetime.fromtimestamp(meta['init'])
+
+        blockSize, indexEnd, self.blocks = 1024, end + 1, []
+        if os.path.exists(filePath + '.idx'):
+            with open(filePath + '.idx') as f:
+                index = json.load(f)
+            if index['end'] <= len(self.map):
+                blockSize, indexEnd, self.blocks = index['blockSize'], index['end'], index['blocks']
+        self._indexTail_(indexEnd, blockSize)
+        self.starts = [block[0] for block in self.blocks]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _indexTail_(self, offset, blockSize):
+        # Index the messages from offset to the end of the file.
+        blocks, mapped = self.blocks, self.map
+        size = len(mapped)
+        while offset < size:
+            end = mapped.find(b'\n', offset)
+            if end < 0:
+                break  # Incomplete last line.
+            epoch, flags = self._parseHead_(offset)
+            if not blocks or blocks[-1][2] >= blockSize:
+                blocks.append([epoch, offset, 0, 0, 0])
+            block = blocks[-1]
+            block[2] += 1
+            if flags & WARNING:
+                block[3] += 1
+            elif flags & ERROR:
+                block[4] += 1
+            offset = end + 1
+        self.end = offset
+
+    def _parseHead_(self, offset):
+        # Read epoch and flags of the record at offset without decoding the
+        # text.
+        head = self.map[offset + 1:offset + 64].split(b',', 2)
+        return float(head[0]), int(head[1])
+
+    def _blockEnd_(self, i):
+        return self.blocks[i + 1][1] if i + 1 < len(self.blocks) else self.end
+
+    def _iterBlock_(self, i, level):
+        # Yield (offset, epoch) of the records of level in block i.
+        mapped = self.map
+        offset, end = self.blocks[i][1], self._blockEnd_(i)
+        while offset < end:
+            epoch, flags = self._parseHead_(offset)
+            if _isLevel_(flags, level):
+                yield offset, epoch
+            offset = mapped.find(b'\n', offset) + 1
+
+    def _record_(self, offset):
+        end = self.map.find(b'\n', offset)
+        epoch, flags, text = json.loads(self.map[offset:end])
+        return Message.fromRecord(epoch, text, flags)
+
+    def _blockCount_(self, i, level):
+        # Number of messages of level in block i.
+        block = self.blocks[i]
+        if level is None:
+            return block[2]
+        if level == 'message':
+            return block[2] - block[3] - block[4]
+        return block[3] if level == 'warning' else block[4]
+
+    def query(self, level=None, since=None, until=None):
+        # Messages of level ('message', 'warning', 'error' or None for all)
+        # between since and until, inclusive.
+        since, until = _toEpoch_(since, -5e-7), _toEpoch_(until, 5e-7)
+        first = 0 if since is None else max(bisect_left(self.starts, since) - 1, 0)
+        last = len(self.blocks) if until is None else bisect_right(self.starts, until)
+        for i in range(first, last):
+            if not self._blockCount_(i, level):
+                continue
+            for offset, epoch in self._iterBlock_(i, level):
+                if since is not None and epoch < since:
+                    continue
+                if until is not None and epoch > until:
+                    return
+                yield self._record_(offset)
+
+    def errors(self, since=None, until=None):
+        return list(self.query('error', since, until))
+
+    def warnings(self, since=None, until=None):
+        return list(self.query('warning', since, until))
+
+    def last(self, n, level=None):
+        # The last n messages of level, oldest first.
+        found = []
+        for i in range(len(self.blocks) - 1, -1, -1):
+            if len(found) >= n:
+                break
+            if not self._blockCount_(i, level):
+                continue
+            offsets = [offset for offset, epoch in self._iterBlock_(i, level)]
+            found[:0] = offsets[max(len(offsets) - (n - len(found)), 0):]
+        return [self._record_(offset) for offset in found]
+
+    def count(self, level=None):
+        # Number of messages of level in the file.
+        return sum(self._blockCount_(i, level) for i in range(len(self.blocks)))
+
+    def iter_log_lines(self, title=None):
+        # Yield the log in the text format of Log.iter_log_lines.
+        log = Log()
+        log.init = self.init
+        log.warningCount = self.count('warning')
+        log.errorCount = self.count('error')
+
+        yield log._logHeader_(title or self.title)
+        mapped, offset = self.map, self.blocks[0][1] if self.blocks else self.end
+        while offset < self.end:
+            end = mapped.find(b'\n', offset)
+            epoch, flags, text = json.loads(mapped[offset:end])
+            for line in Message.fromRecord(epoch, text, flags).iterMessage():
+                yield line
+            offset = end + 1
+        yield log._logFooter_()
+
+    def returnLogAsString(self, title=None):
+        return ''.join(self.iter_log_lines(title))
+
+
+_levelFlags_ = {'message': 0, 'warning': WARNING, 'error': ERROR, True: ERROR, False: 0}
+
+
+def _isLevel_(flags, level):
+    #True if a message with flags is of level ('message', 'warning', 'error'
+    #or None for any).
+    if level is None:
+        return True
+    if level == 'error':
+        return bool(flags & ERROR)
+    if level == 'warning':
+        return bool(flags & WARNING)
+    return not flags & (ERROR | WARNING)
+
+
+def _toEpoch_(value, widen=0.0):
+    #Epoch seconds of a datetime, float or None. A datetime is moved by widen
+    #seconds. Message.time rounds the stored epoch to microseconds, so a time
+    #bound taken from a message is widened by half a microsecond to include
+    #that message.
+    if isinstance(value, time.datetime):
+        return value.timestamp() + widen
+    return value
+
+
+def _compressFile_(path, method, level=None):
+    #Compress the file at path with method ('gzip', 'bz2', 'lzma' or 'zstd')
+    #in chunks, remove the original and return the new path.
+    if method == 'gzip':
+        target = path + '.gz'
+        out = gzip.open(target, 'wb', compresslevel=9 if level is None else level)
+    elif method == 'bz2':
+        target = path + '.bz2'
+        out = bz2.open(target, 'wb', compresslevel=9 if level is None else level)
+    elif method == 'lzma':
+        target = path + '.xz'
+        out = lzma.open(target, 'wb', preset=level)
+    else:
+        target = path + '.zst'
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        out = compressor.stream_writer(open(target, 'wb'))
+
+    with open(path, 'rb') as source, out:
+        shutil.copyfileobj(source, out, 1 << 20)
+    os.remove(path)
+    return target
+
+
+class RotatingFileSink(FileSink):
+    # FileSink that starts a new file when the current one grows past
+    # maxBytes or gets older than maxAge seconds. The full file is closed with
+    # the summary footer and renamed to filePath.1, filePath.2 etc. in order of
+    # rotation, and the new file starts with the log header. At most
+    # maxBackups rotated files are kept, oldest removed first.
+    #
+    # Rotated files can be compressed with 'gzip', 'bz2', 'lzma', or 'zstd'
+    # (requires the zstandard package). Compression and removal run in order
+    # on a background thread, so writing never waits for them.
+    #
+    # The size is counted in characters written, which equals bytes for
+    # ASCII logs.
+
+    def __init__(self, filePath, maxBytes=None, maxAge=None, maxBackups=None, compress=None, compressLevel=None,
+                 bufferSize=65536, flushCount=None, flushInterval=None, flushOnError=True):
+        # Input:
+        #       filePath        string, Full path of the log file.
+        #       maxBytes        int, Rotate when the file reaches this size.
+        #       maxAge          float, Rotate when the file is this many
+        #                              seconds old.
+        #       maxBackups      int, Number of rotated files to keep. None
+        #                            keeps all.
+        #       compress        string, Compression of rotated files. None
+        #                               leaves them as they are.
+        #       compressLevel   int, Compression level. None uses the
+        #                            default of the method.
+        #       bufferSize, flushCount, flushInterval, flushOnError
+        #                       Flush policy. See FileSink.
+        assert compress in (None, 'gzip', 'bz2', 'lzma', 'zstd')
+        if compress == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression of log files requires the zstandard package.')
+
+        FileSink.__init__(self, filePath, bufferSize, flushCount, flushInterval, flushOnError)
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.maxBackups = maxBackups
+        self.compress = compress
+        self.compressLevel = compressLevel
+        self.rotations = 0
+        self.backups = deque()
+        self.size = 0
+        self.opened = epochTime()
+        self._jobs_ = None
+
+    def open(self, log, title):
+        self.log = log
+        self.title = title
+        header = log._logHeader_(title)
+        self.file.write(header)
+        self.size += len(header)
+
+    def _write_(self, message):
+        text = message.getMessage()
+        if self.maxBytes is not None and self.size + len(text) > self.maxBytes and self.size:
+            self.rotate()
+        elif self.maxAge is not None and epochTime() - self.opened >= self.maxAge:
+            self.rotate()
+        self.file.write(text)
+        self.size += len(text)
+        self._written_(message)
+
+    def rotate(self):
+        # Close the current file, move it to the next backup name and start a
+        # new file.
+        self.file.write(self.log._logFooter_())
+        self.file.close()
+
+        self.rotations += 1
+        backup = '%s.%d' % (self.filePath, self.rotations)
+        os.replace(self.filePath, backup)
+
+        self.file = open(self.filePath, 'w', buffering=self.bufferSize)
+        self.size = 0
+        self.opened = epochTime()
+        self._pending_ = 0
+        self.open(self.log, self.title)
+
+        if self.compress:
+            if self._jobs_ is None:
+                self._jobs_ = Queue()
+                self._thread_ = threading.Thread(target=self._compressRotated_, name='LogRotation', daemon=True)
+                self._thread_.start()
+            self._jobs_.put(backup)
+        else:
+            self._keep_(backup)
 
-        return '%s%s%s%s' % (line, stamp, label, text)
+    def close(self, log):
+        FileSink.close(self, log)
+        if self._jobs_ is not None:
+            self._jobs_.put(None)
+            self._thread_.join()
+            self._jobs_ = None
+
+    def _compressRotated_(self):
+        while True:
+            backup = self._jobs_.get()
+            if backup is None:
+                return
+            self._keep_(_compressFile_(backup, self.compress, self.compressLevel))
+
+    def _keep_(self, backup):
+        # Register a finished backup file and remove the oldest beyond
+        # maxBackups.
+        self.backups.append(backup)
+        while self.maxBackups is not None and len(self.backups) > self.maxBackups:
+            os.remove(self.backups.popleft())
+
+
+class EmailSink(object):
+    # Sink that mails the log as digests. Messages are collected and sent as
+    # one mail when digestCount messages are waiting or digestInterval seconds
+    # have passed since the first of them, but never more often than once
+    # every minSendInterval seconds. Messages beyond maxBuffered while waiting
+    # are dropped and counted in the next digest. The last digest is sent on
+    # close, with the summary footer and the files in attachments.
+    #
+    # All connecting and sending is done by a thread of the sink. Writing a
+    # message only buffers its line and wakes the thread when a digest is
+    # due, so logging never waits for the SMTP server.
+    #
+    # A digest that cannot be sent does not fail the logging call. Its lines
+    # are kept for the next digest, the failure is counted in failures with
+    # the exception in lastError, and sending is retried after retryInterval
+    # seconds.
+    #
+    # One SMTP connection is reused between digests. A connection idle for
+    # more than keepalive seconds is checked with NOOP, and a lost connection
+    # is opened again. Mails are written to the connection in chunks, so
+    # large attachments are never read into memory in full.
+
+    def __init__(self, host, sender, recipients, subject='Log', port=25, digestCount=1000, digestInterval=60.0,
+                 minSendInterval=10.0, maxBuffered=100000, attachments=(), username=None, password=None,
+                 starttls=False, keepalive=30.0, timeout=30.0, retryInterval=60.0):
+        # Input:
+        #       host, port      SMTP server.
+        #       sender          string, From address.
+        #       recipients      list, To addresses.
+        #       subject         string, Subject of the digests.
+        #       digestCount     int, Messages per digest.
+        #       digestInterval  float, Seconds before a digest is sent.
+        #       minSendInterval float, Minimum seconds between digests.
+        #       maxBuffered     int, Maximum number of waiting messages.
+        #       attachments     list, Paths of files attached to the last
+        #                             digest, e.g. the log file.
+        #       username, password, starttls
+        #                       Login and encryption of the connection.
+        #       keepalive       float, Seconds idle before the connection is
+        #                              checked before use.
+        #       timeout         float, Socket timeout in seconds.
+        #       retryInterval   float, Seconds before a failed digest is
+        #                              sent again.
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = list(recipients)
+        self.subject = subject
+        self.digestCount = digestCount
+        self.digestInterval = digestInterval
+        self.minSendInterval = minSendInterval
+        self.maxBuffered = maxBuffered
+        self.attachments = list(attachments)
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.retryInterval = retryInterval
+
+        self.sent = 0
+        self.dropped = 0
+        self.failures = 0
+        self.lastError = None
+        self.smtp = None
+        self._lines_ = []
+        self._first_ = None
+        self._lastSend_ = None
+        self._lastUse_ = None
+        self._retryAt_ = None
+        self._flushes_ = []
+        self._final_ = None
+        self._lock_ = threading.RLock()
+        self._wake_ = threading.Event()
+        self._thread_ = None
+
+    def open(self, log, title):
+        self.log = log
+        self.title = title
+        if self._thread_ is None:
+            self._thread_ = threading.Thread(target=self._run_, name='EmailDigest', daemon=True)
+            self._thread_.start()
+
+    def write(self, message):
+        with self._lock_:
+            lines = self._lines_
+            if len(lines) >= self.maxBuffered:
+                self.dropped += 1
+            else:
+                lines.append(message.getMessage(newline=False))
+            now = default_timer()
+            if self._first_ is None:
+                self._first_ = now
+            if self._due_(now):
+                self._wake_.set()
+
+    def _due_(self, now):
+        # True if the waiting messages should be sent now.
+        if not self._lines_ and not self.dropped:
+            return False
+        if self._retryAt_ is not None and now < self._retryAt_:
+            return False
+        if self._lastSend_ is not None and now - self._lastSend_ < self.minSendInterval:
+            return False
+        return len(self._lines_) >= self.digestCount or now - self._first_ >= self.digestInterval
+
+    def _run_(self):
+        # Send the digests that are due, those asked for by flush, and the
+        # last one handed over by close.
+        tick = min(max(min(self.digestInterval, self.retryInterval) / 4, 0.01), 1.0)
+        while True:
+            self._wake_.wait(tick)
+            self._wake_.clear()
+            with self._lock_:
+                flushes, self._flushes_ = self._flushes_, []
+                final = self._final_
+                due = self._due_(default_timer()) or (flushes and (self._lines_ or self.dropped))
+            try:
+                if final is not None:
+                    try:
+                        self._sendDigest_(*final)
+                    finally:
+                        self.disconnect()
+                    return
+                if due:
+                    self._sendDigest_()
+            finally:
+                for done in flushes:
+                    done.set()
+
+    def flush(self):
+        # Have the waiting messages sent as a digest, ignoring the send
+        # intervals, and wait until the sink thread has tried to.
+        thread = self._thread_
+        if thread is None:
+            return
+        done = threading.Event()
+        with self._lock_:
+            self._flushes_.append(done)
+        self._wake_.set()
+        while not done.wait(0.1):
+            if not thread.is_alive():
+                return
+
+    def close(self, log):
+        # Hand the last digest with footer and attachments to the sink thread,
+        # and wait for it to be sent and the connection closed. Lines that
+        # could not be sent are left in unsent.
+        final = (log._logFooter_().strip('\n'), self.attachments)
+        thread, self._thread_ = self._thread_, None
+        if thread is None or not thread.is_alive():
+            try:
+                self._sendDigest_(*final)
+            finally:
+                self.disconnect()
+            return
+        with self._lock_:
+            self._final_ = final
+        self._wake_.set()
+        thread.join()
+
+    @property
+    def unsent(self):
+        # Lines waiting to be sent.
+        with self._lock_:
+            return list(self._lines_)
+
+    def disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def _sendDigest_(self, footer='', attachments=()):
+        # Send the waiting lines. Returns False, and keeps the lines for the
+        # next digest, if the mail could not be sent. The lock is only held
+        # while taking and putting back lines, not while sending.
+        with self._lock_:
+            lines, self._lines_ = self._lines_, []
+            dropped, self.dropped = self.dropped, 0
+            first, self._first_ = self._first_, None
+            self._lastSend_ = default_timer()
+        text = list(lines)
+        if dropped:
+            text.append('%d messages were dropped from this digest.' % dropped)
+        if footer:
+            text.append(footer)
+        try:
+            self.send('%s: %s' % (self.subject, self.title), '\n'.join(text), attachments)
+        except (smtplib.SMTPException, OSError) as error:
+            self.disconnect()
+            with self._lock_:
+                self.failures += 1
+                self.lastError = error
+                self._retryAt_ = default_timer() + self.retryInterval
+                lines.extend(self._lines_)
+                self.dropped += dropped + max(len(lines) - self.maxBuffered, 0)
+                self._lines_ = lines[-self.maxBuffered:]
+                self._first_ = first if first is not None else self._first_
+            return False
+        with self._lock_:
+            self._retryAt_ = None
+        return True
+
+    def _connection_(self):
+        # Return an open SMTP connection, reusing the current one if alive.
+        if self.smtp is not None:
+            if default_timer() - self._lastUse_ < self.keepalive:
+                return self.smtp
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.disconnect()
+
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        self.smtp = smtp
+        return smtp
+
+    def send(self, subject, text, attachments=()):
+        # Mail text with attachments to the recipients. Retries once on a new
+        # connection if the current one was lost.
+        try:
+            self._send_(self._connection_(), subject, text, attachments)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.smtp = None
+            self._send_(self._connection_(), subject, text, attachments)
+        self._lastUse_ = default_timer()
+        self.sent += 1
+
+    def _send_(self, smtp, subject, text, attachments):
+        smtp.ehlo_or_helo_if_needed()
+        code, response = smtp.mail(self.sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response, self.sender)
+        for recipient in self.recipients:
+            code, response = smtp.rcpt(recipient)
+            if code not in (250, 251):
+                smtp.rset()
+                raise smtplib.SMTPRecipientsRefused({recipient: (code, response)})
+        smtp.putcmd('data')
+        code, response = smtp.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, response)
+
+        for chunk in self._mimeChunks_(subject, text, attachments):
+            smtp.send(chunk)
+        smtp.send(b'\r\n.\r\n')
+        code, response = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+    def _mimeChunks_(self, subject, text, attachments):
+        # Yield the mail as bytes. All parts are base64 encoded, so no line
+        # needs dot stuffing, and files are encoded a chunk at a time.
+        boundary = '==log-%s==' % make_msgid().strip('<>').split('@')[0]
+        if not subject.isascii():
+            subject = Header(subject, 'utf-8').encode()
+        head = ['From: %s' % self.sender,
+                'To: %s' % ', '.join(self.recipients),
+                'Subject: %s' % subject,
+                'Date: %s' % formatdate(localtime=True),
+                'Message-ID: %s' % make_msgid(),
+                'MIME-Version: 1.0',
+                'Content-Type: multipart/mixed; boundary="%s"' % boundary,
+                '',
+                '--%s' % boundary,
+                'Content-Type: text/plain; charset="utf-8"',
+                'Content-Transfer-Encoding: base64',
+                '', '']
+        yield '\r\n'.join(head).encode('ascii')
+        yield base64.encodebytes(text.encode('utf-8')).replace(b'\n', b'\r\n')
+
+        for path in attachments:
+            name = os.path.basename(path)
+            mimeType = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            part = ['--%s' % boundary,
+                    'Content-Type: %s' % mimeType,
+                    'Content-Transfer-Encoding: base64',
+                    'Content-Disposition: attachment; filename="%s"' % name,
+                    '', '']
+            yield '\r\n'.join(part).encode('ascii')
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(57 * 1024)  # Whole 76 character base64 lines.
+                    if not chunk:
+                        break
+                    yield base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+        yield ('--%s--' % boundary).encode('ascii')
+
+
+class LogWriter(object):
+    # Background writer for a Log in asynchronous mode. The add methods of the
+    # Log only append a raw (epoch, text, flags, toScreen) record to a deque,
+    # and a single thread stores, formats and writes the records in batches,
+    # with one screen write per batch.
+    #
+    # The queue is bounded by queueSize. When it is full, overflow='block'
+    # makes the caller wait for the writer, and overflow='drop' discards the
+    # record and counts it in dropped.
+    #
+    # An exception from the store or a sink while a record is written is
+    # counted in failures and kept in lastError, and the writer goes on with
+    # the next record. If the thread is gone all the same, put, flush and close
+    # write in the calling thread instead of waiting for it.
+
+    def __init__(self, log, queueSize=100000, overflow='block', batchSize=1000, interval=0.05):
+        # Input:
+        #       log             Log, The log the records belong to.
+        #       queueSize       int, Maximum number of queued records.
+        #       overflow        string, 'block' or 'drop'.
+        #       batchSize       int, Maximum number of records per batch.
+        #       interval        float, Seconds the writer sleeps when idle.
+        assert overflow in ('block', 'drop')
+
+        self.log = log
+        self.queue = deque()
+        self.queueSize = queueSize
+        self.block = overflow == 'block'
+        self.batchSize = batchSize
+        self.interval = interval
+        self.dropped = 0
+        self.failures = 0
+        self.lastError = None
+        self._wake_ = threading.Event()
+        self._space_ = threading.Condition()
+        self.thread = threading.Thread(target=self._run_, name='LogWriter', daemon=True)
+        self.thread.start()
+
+    def put(self, record):
+        # Queue a record. Returns False if it was dropped.
+        queue = self.queue
+        if len(queue) >= self.queueSize:
+            if not self.block:
+                self.dropped += 1
+                return False
+            with self._space_:
+                self._wake_.set()
+                while len(queue) >= self.queueSize and self.thread.is_alive():
+                    self._space_.wait(self.interval)
+        if not self.thread.is_alive():
+            self._drain_()
+            self._write_([record])
+            return True
+        queue.append(record)
+        return True
+
+    def flush(self):
+        # Wait until every record queued so far is written and the sinks of
+        # the log are flushed.
+        if not self.thread.is_alive():
+            self._drain_()
+            return
+        done = threading.Event()
+        self.queue.append(done)
+        self._wake_.set()
+        while not done.wait(self.interval):
+            if not self.thread.is_alive():
+                self._drain_()
+                return
+
+    def close(self):
+        # Write the remaining records and stop the writer thread.
+        if self.thread.is_alive():
+            self.queue.append(None)
+            self._wake_.set()
+            self.thread.join()
+        self._drain_()
+
+    def _drain_(self):
+        # Write the records left in the queue by a writer thread that is gone,
+        # in the calling thread.
+        queue = self.queue
+        while queue:
+            try:
+                batch = [queue.popleft()]
+            except IndexError:
+                break
+            self._write_(batch)
+
+    def _run_(self):
+        queue = self.queue
+        popleft = queue.popleft
+        while True:
+            if not queue:
+                self._wake_.wait(self.interval)
+                self._wake_.clear()
+                continue
+
+            batch = []
+            while queue and len(batch) < self.batchSize:
+                batch.append(popleft())
+            with self._space_:
+                self._space_.notify_all()
+
+            if not self._write_(batch):
+                with self._space_:
+                    self._space_.notify_all()
+                return
+
+    def _write_(self, batch):
+        # Write a batch of records. Flush markers are set in order, and False
+        # is returned when the stop marker is found.
+        log = self.log
+        lines = []
+        for record in batch:
+            if isinstance(record, tuple):
+                epoch, text, flags, toScreen = record
+                try:
+                    line = log._write_(epoch, text, flags, toScreen)
+                except Exception as e:
+                    self._fail_(e)
+                    continue
+                if line is not None:
+                    lines.append(line)
+                continue
+
+            if lines:
+                self._print_(lines)
+                lines = []
+            if record is None:
+                return False
+            for sink in log.sinks:
+                try:
+                    sink.flush()
+                except Exception as e:
+                    self._fail_(e)
+            record.set()
+
+        if lines:
+            self._print_(lines)
+        return True
+
+    def _print_(self, lines):
+        try:
+            sys.stdout.write('\n'.join(lines) + '\n')
+        except Exception as e:
+            self._fail_(e)
+
+    def _fail_(self, error):
+        self.failures += 1
+        self.lastError = error
+
+
+_nameIncrements_ = {}  #Next file name increment per (path, filename).
 
 
 class Log(object):
     #Creates a logfile instance that handles messages and can store them in a
     #text file.
 
-    def __init__(self,dynamicPrintToScreen = False, timestamp = True):
+    def __init__(self,dynamicPrintToScreen = False, timestamp = True, streamPath=None, streamName=None,
+                 streamTitle='Log', completeName=False, bufferSize=65536, flushCount=None, flushInterval=None,
+                 flushOnError=True, monotonicClock=False, asynchronous=False, queueSize=100000,
+                 overflow='block', maxBytes=None, maxAge=None, maxBackups=None, compress=None, tracer=None,
+                 maxMessages=None, maxLevelMessages=None, dedupWindow=None):
         #File is the base name of the log file. The name will have a timestamp
         #appended, and the name will be incremented if there are several log
         #files with the same timestamp.
@@ -92,13 +1495,221 @@ class Log(object):
         # dynamicPrintToScreen      boolean, if True, all message methods will
         #                                    print to screen as well as print
         #                                    to log.
+        # streamPath                string, If given, the log is streamed to a
+        #                                   file in this folder as messages are
+        #                                   added, and messages are not kept in
+        #                                   memory. See openLogFile.
+        # streamName                string, Log file name prefix for streaming.
+        # streamTitle               string, The title of the streamed log.
+        # completeName              boolean, Use streamName as is.
+        # bufferSize, flushCount, flushInterval, flushOnError
+        #                           Flush policy of the stream. See FileSink.
+        # monotonicClock            boolean, Time messages with the monotonic
+        #                                    clock, counted from the start time
+        #                                    of the log, so that message times
+        #                                    never go backwards when the system
+        #                                    clock is adjusted.
+        # asynchronous              boolean, Hand messages to a background
+        #                                    LogWriter thread that stores and
+        #                                    writes them. Call close(), or use
+        #                                    the log as a context manager.
+        # queueSize, overflow       Queue bound and overflow policy of the
+        #                           writer, see LogWriter.
+        # maxBytes, maxAge, maxBackups, compress
+        #                           Rotation of the stream. See
+        #                           RotatingFileSink.
+        # tracer                    tracer.Tracer, Records errors and
+        #                                   warnings as instant events.
+        # maxMessages, maxLevelMessages, dedupWindow
+        #                           Keep only the last messages in memory
+        #                           and collapse repeated messages, also in
+        #                           the stream. See BoundedMessageStore.
 
-        self.m = []  #List of Message objects.
+        self.m = MessageStore()  #Messages, see MessageStore.
+        if maxMessages is not None:
+            self.m = BoundedMessageStore(maxMessages, maxLevelMessages, dedupWindow)
         self.init = time.datetime.now()
         self.dynamicPrintToScreen = dynamicPrintToScreen
         self.timestamp = timestamp
         self.errorCount = 0
         self.warningCount = 0
+        self.keepMessages = True
+        self.sinks = []
+        self.tracer = tracer
+        self._lock_ = threading.Lock()  #Guards the store, sinks and counters.
+        self._clock_ = epochTime
+        if monotonicClock:
+            initEpoch, initTimer = self.init.timestamp(), default_timer()
+            self._clock_ = lambda: initEpoch + (default_timer() - initTimer)
+
+        if streamPath is not None:
+            self.openLogFile(streamPath, streamName, streamTitle, completeName, bufferSize, flushCount,
+                             flushInterval, flushOnError, maxBytes, maxAge, maxBackups, compress)
+            self.keepMessages = maxMessages is not None
+
+        self.writer = None
+        self._dropped_ = 0
+        if asynchronous:
+            self.writer = LogWriter(self, queueSize, overflow)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def droppedCount(self):
+        # Number of messages dropped by a full asynchronous queue.
+        return self._dropped_ + (self.writer.dropped if self.writer else 0)
+
+    def openLogFile(self, path, namebase, title='Log', completeName=False, bufferSize=65536, flushCount=None,
+                    flushInterval=None, flushOnError=True, maxBytes=None, maxAge=None, maxBackups=None,
+                    compress=None, compressLevel=None, format='text'):
+        # Open a log file that every following message is written to as it is
+        # added. The header is written immediately and the summary footer is
+        # written by close(). File naming follows printLogToFile.
+        #
+        # Input:
+        #       path            string, Path to log folder.
+        #       namebase        string, Log file name prefix.
+        #       title           string, The title of the log.
+        #       completeName    boolean, Use namebase as is.
+        #       bufferSize, flushCount, flushInterval, flushOnError
+        #                       Flush policy. See FileSink.
+        #       maxBytes, maxAge, maxBackups, compress, compressLevel
+        #                       Rotation of the file. If maxBytes or maxAge
+        #                       is given, see RotatingFileSink.
+        #       format          string, 'text' or 'jsonl'. See
+        #                               StructuredSink.
+
+        assert format in ('text', 'jsonl')
+        if not completeName:
+            namebase = self._addTimeStampToFileName_(namebase, 'txt' if format == 'text' else format)
+            namebase = self._getFileNameIncrement_(path, namebase)
+
+        self.log_file_path = os.path.join(path, namebase)
+        if format == 'jsonl':
+            assert maxBytes is None and maxAge is None, 'Structured log files are not rotated.'
+            sink = StructuredSink(self.log_file_path, bufferSize=bufferSize, flushCount=flushCount,
+                                  flushInterval=flushInterval, flushOnError=flushOnError)
+        elif maxBytes is not None or maxAge is not None:
+            sink = RotatingFileSink(self.log_file_path, maxBytes, maxAge, maxBackups, compress, compressLevel,
+                                    bufferSize, flushCount, flushInterval, flushOnError)
+        else:
+            sink = FileSink(self.log_file_path, bufferSize, flushCount, flushInterval, flushOnError)
+        self.addSink(sink, title)
+        return sink
+
+    def addSink(self, sink, title='Log'):
+        # Attach a sink object that receives every message added from now on.
+        # A sink implements open(log, title), write(message), flush() and
+        # close(log).
+        sink.open(self, title)
+        self.sinks.append(sink)
+
+    def flush(self):
+        # Flush all attached sinks. In asynchronous mode, wait for all queued
+        # messages to be written first.
+        if self.writer:
+            self.writer.flush()
+            return
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        # Write the summary footer to all attached sinks and close them. In
+        # asynchronous mode, queued messages are written and the writer thread
+        # stopped first.
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.close()
+            self._dropped_ += writer.dropped
+        with self._lock_:
+            line = self._writeRepeats_()
+        if line is not None:
+            print(line)
+        # Every sink is closed, also when one of them fails:
+        sinks, self.sinks = self.sinks, []
+        failure = None
+        for sink in sinks:
+            try:
+                sink.close(self)
+            except Exception as error:
+                if failure is None:
+                    failure = error
+        if failure is not None:
+            raise failure
+
+    def _add_(self, text, timestamp, newLine, flags, toScreen):
+        # Time stamp the message and write it, or queue it for the writer
+        # thread in asynchronous mode.
+        #
+        # The counters, store and sinks are updated under the log lock, so a
+        # log can be written from several threads. The lock is taken once per
+        # message.
+        if timestamp: flags |= TIMESTAMP
+        if newLine: flags |= NEWLINE
+        if self.writer:
+            if flags & (ERROR | WARNING):
+                with self._lock_:
+                    self._count_(flags)
+            self.writer.put((self._clock_(), text, flags, toScreen))
+            return
+        with self._lock_:
+            self._count_(flags)
+            line = self._writeLocked_(self._clock_(), text, flags, toScreen)
+        if line is not None:
+           print(line)
+
+    def _count_(self, flags):
+        # Count an error or warning. Called under the log lock.
+        if flags & ERROR:
+            self.errorCount += 1
+        elif flags & WARNING:
+            self.warningCount += 1
+
+    def _write_(self, epoch, text, flags, toScreen):
+        # Store message and pass it on to sinks, under the log lock. Returns
+        # the screen line if the message should be printed.
+        with self._lock_:
+            return self._writeLocked_(epoch, text, flags, toScreen)
+
+    def _writeLocked_(self, epoch, text, flags, toScreen):
+        # _write_ for callers holding the log lock. A Message object is only
+        # created when something other than the store needs it.
+        #
+        # Messages collapsed by a BoundedMessageStore are not written. Their
+        # repeat counts are written before the next message that is.
+        repeats = None
+        if self.keepMessages:
+            if self.m.add(epoch, text, flags):
+                return
+            if self.m.pending and self.m.repeatsDue(epoch):
+                repeats = self._writeRepeats_(epoch)
+        if self.sinks or toScreen or self.dynamicPrintToScreen:
+            message = Message.fromRecord(epoch, text, flags)
+            for sink in self.sinks:
+                sink.write(message)
+            if toScreen or self.dynamicPrintToScreen:
+               line = message.getMessage(newline=False)
+               return line if repeats is None else '%s\n%s' % (repeats, line)
+        return repeats
+
+    def _writeRepeats_(self, epoch=None):
+        # Write the repeat counts of collapsed messages that are due at epoch,
+        # or all if None, to the sinks. Returns the screen lines if the log
+        # prints to screen.
+        if not self.m.pending:
+            return None
+        messages = [Message.fromRecord(*record) for record in self.m.takeRepeats(epoch)]
+        if not messages:
+            return None
+        for message in messages:
+            for sink in self.sinks:
+                sink.write(message)
+        if self.dynamicPrintToScreen:
+            return '\n'.join(message.getMessage(newline=False) for message in messages)
 
     def addMessage(self, text, timestamp=None, newLine=True,toScreen = False):
         #Add message to log.
@@ -110,9 +1721,7 @@ class Log(object):
         #       newLine         boolean, Write message to new line in file
         #                                (True), or append to current (False).
         if timestamp is None: timestamp = self.timestamp
-        self.m.extend([Message(text, timestamp, newLine)])
-        if toScreen or self.dynamicPrintToScreen:
-           print(self.m[-1].getMessage(newline=False))
+        self._add_(text, timestamp, newLine, 0, toScreen)
 
     def addWarning(self, text, timestamp=None, newLine=True, toScreen=False):
         # Add warning message to log. Only difference to addMessage is the
@@ -126,10 +1735,9 @@ class Log(object):
         #       newLine         boolean, Write message to new line in file
         #                                (True), or append to current (False).
         if timestamp is None: timestamp = self.timestamp
-        self.m.extend([Message(text, timestamp, newLine, warning=True)])
-        self.warningCount += 1
-        if toScreen or self.dynamicPrintToScreen:
-           print(self.m[-1].getMessage(newline=False))
+        if self.tracer is not None:
+            self.tracer.instant('Warning', {'text': text})
+        self._add_(text, timestamp, newLine, WARNING, toScreen)
 
     def addError(self, text, timestamp=None, newLine=True, toScreen=False):
         # Add error message to log. Only difference to addMessage is the
@@ -143,10 +1751,145 @@ class Log(object):
         #       newLine         boolean, Write message to new line in file
         #                                (True), or append to current (False).
         if timestamp is None: timestamp = self.timestamp
-        self.m.extend([Message(text, timestamp, newLine, error=True)])
-        self.errorCount += 1
-        if toScreen or self.dynamicPrintToScreen:
-           print(self.m[-1].getMessage(newline=False))
+        if self.tracer is not None:
+            self.tracer.instant('Error', {'text': text})
+        self._add_(text, timestamp, newLine, ERROR, toScreen)
+
+    def add_many(self, texts, level='message', timestamp=None, newLine=True, toScreen=False):
+        # Add a batch of messages. The clock is read once, so all messages get
+        # the same time, the counters are updated once per batch and the
+        # messages printed to screen in one write.
+        #
+        # Input:
+        #       texts           list, Messages for log.
+        #       level           string/list, 'message', 'warning' or 'error'
+        #                               for all texts, or a sequence of one
+        #                               level per text. A sequence of
+        #                               booleans, e.g. a NumPy bool array,
+        #                               marks the errors.
+        #       timestamp       boolean, Add time stamp to messages.
+        #       newLine         boolean, See addMessage.
+        if timestamp is None: timestamp = self.timestamp
+        base = (TIMESTAMP if timestamp else 0) | (NEWLINE if newLine else 0)
+        if not isinstance(texts, list):
+            texts = list(texts)
+
+        if isinstance(level, str):
+            flags = bytes([base | _levelFlags_[level]]) * len(texts)
+        elif getattr(level, 'dtype', None) == bool:
+            flags = (level.astype('uint8') * ERROR + base).tobytes()
+        else:
+            flags = bytes([base | _levelFlags_[value] for value in level])
+        assert len(flags) == len(texts), 'One level per text.'
+
+        errors, warnings = flags.count(base | ERROR), flags.count(base | WARNING)
+        with self._lock_:
+            self.errorCount += errors
+            self.warningCount += warnings
+        if self.tracer is not None and (errors or warnings):
+            self.tracer.instant('Batch', {'errors': errors, 'warnings': warnings})
+
+        epoch = self._clock_()
+        if self.writer:
+            put = self.writer.put
+            for text, value in zip(texts, flags):
+                put((epoch, text, value, toScreen))
+            return
+
+        screen = toScreen or self.dynamicPrintToScreen
+        with self._lock_:
+            if isinstance(self.m, BoundedMessageStore) and self.keepMessages:
+                # Repeats are collapsed message by message:
+                lines = [self._writeLocked_(epoch, text, value, toScreen) for text, value in zip(texts, flags)]
+                lines = [line for line in lines if line is not None]
+            else:
+                if self.keepMessages:
+                    self.m.addMany(epoch, texts, flags)
+                lines = []
+                if self.sinks or screen:
+                    messages = [Message.fromRecord(epoch, text, value) for text, value in zip(texts, flags)]
+                    for sink in self.sinks:
+                        for message in messages:
+                            sink.write(message)
+                    if screen:
+                        lines = [message.getMessage(newline=False) for message in messages]
+        if lines:
+            print('\n'.join(lines))
+
+    def errors(self, since=None, until=None):
+        # Return the error messages from since to until, as Message objects.
+        #
+        # Input:
+        #       since, until    datetime/float, Time limits as datetime or
+        #                                       epoch seconds, inclusive.
+        #                                       None is unlimited.
+        return self.query('error', since, until)
+
+    def warnings(self, since=None, until=None):
+        # Return the warning messages from since to until. See errors.
+        return self.query('warning', since, until)
+
+    def query(self, level=None, since=None, until=None):
+        # Return the messages of level from since to until. Uses the indexes
+        # of the message store, so the cost grows with the number of messages
+        # returned, not with the size of the log. Only messages kept in memory
+        # are searched.
+        #
+        # The queries read the store under the log lock, so they can be used
+        # to monitor a log from another thread while it is written.
+        #
+        # Input:
+        #       level           string, 'message', 'warning', 'error' or
+        #                               None for all.
+        #       since, until    datetime/float, See errors.
+        since, until = _toEpoch_(since, -5e-7), _toEpoch_(until, 5e-7)
+        store = self.m
+        with self._lock_:
+            return [store[i] for i in store.indices(level, since, until)]
+
+    def last(self, n, level=None):
+        # Return the last n messages of level, oldest first.
+        store = self.m
+        with self._lock_:
+            return [store[i] for i in store.last(n, level)]
+
+    def count(self, level=None, window=None):
+        # Return the number of messages of level within the last window.
+        #
+        # Input:
+        #       level           string, See query.
+        #       window          float/timedelta, Length of the window back
+        #                                        from now, in seconds. None
+        #                                        counts all.
+        since = None
+        if window is not None:
+            if isinstance(window, time.timedelta):
+                window = window.total_seconds()
+            since = self._clock_() - window
+        with self._lock_:
+            return self.m.count(level, since)
+
+    def iter_log_lines(self, title='Run log'):
+        # Yield the log text piece by piece: header, every formatted message
+        # and the summary footer. Joining the pieces gives the same text as
+        # returnLogAsString, in time linear to the number of messages.
+        #
+        # Input:
+        #       title           string, The title of the log.
+        if self.writer:
+            self.writer.flush()
+        yield self._logHeader_(title)
+        stampOf = _timestampCache.stamp
+        for epoch, text, flags in self.m.records():
+            stamp = ''
+            if flags & TIMESTAMP: stamp = stampOf(epoch)
+            newline, error, warning = flags & NEWLINE, flags & ERROR, flags & WARNING
+            if isinstance(text, list):
+                for item in text:
+                    yield _compileLine_(item, stamp, newline, error, warning)
+            else:
+                yield _compileLine_(text, stamp, newline, error, warning)
+        yield self._logFooter_()
 
     def returnLogAsString(self, title='Run log'):
         # Return entire log as text:
@@ -163,7 +1906,7 @@ class Log(object):
 
         print(self._compileLogText_(title))
 
-    def printLogToFile(self, path, namebase, title='Log', completeName=False, errorTag=False):
+    def printLogToFile(self, path, namebase, title='Log', completeName=False, errorTag=False, format='text'):
         # Create file. "name" is only the name base. Time stamp and file type are
         # added by the script. If completeName = True, then the filename in
         # "name" is taken as is, without adding timestamp or checking for
@@ -178,9 +1921,13 @@ class Log(object):
         #                                time stamps are not added to the name.
         #                                Assumes namebase also contains file
         #                                type suffix.
+        #       format          string, 'text', or 'jsonl' for a structured
+        #                               file with side index that can be
+        #                               read with LogReader.
 
+        assert format in ('text', 'jsonl')
         if not completeName:
-            namebase = self._addTimeStampToFileName_(namebase)
+            namebase = self._addTimeStampToFileName_(namebase, 'txt' if format == 'text' else format)
 
         if errorTag and self.errorCount > 0:
             nameSplit = namebase.split('.')
@@ -191,60 +1938,305 @@ class Log(object):
            namebase = self._getFileNameIncrement_(path, namebase)
 
         self.log_file_path = os.path.join(path, namebase)
+        if format == 'jsonl':
+            sink = StructuredSink(self.log_file_path)
+            try:
+                sink.open(self, title)
+                for epoch, text, flags in self.m.records():
+                    sink.writeRecord(epoch, text, flags)
+            finally:
+                sink.close(self)
+            return
+
         self.log_file = open(self.log_file_path, 'w')
 
         try:
-            self.log_file.write(self._compileLogText_(title))
+            self.log_file.writelines(self.iter_log_lines(title))
         finally:
             self.log_file.close()
 
-    def _addTimeStampToFileName_(self,name):
+    def _addTimeStampToFileName_(self,name, extension='txt'):
         #Add initialization time stamp to file name:
-        timename = self.init.strftime('%Y.%m.%d')
-        filename = '%s_%s.txt' % (name, timename)
+        timename = _timestampCache.stamp(self.init.timestamp())[:10]
+        filename = '%s_%s.%s' % (name, timename, extension)
         return filename
 
     def _getFileNameIncrement_(self, path, filename):
         #Takes suggested file name and checks if file allready exist. If so,
-        #add numeric increment to file name until unique name is found.
+        #add numeric increment to file name until unique name is found. The
+        #name is reserved by creating the file exclusively.
+        #
+        #Increments are assumed to be contiguous, so the first free increment
+        #is found by an exponential and binary search over existing names, and
+        #the last increment used is cached per name. The directory is never
+        #listed.
 
         name = '.'.join(filename.split('.')[0:-1])
         extension = filename.split('.')[-1]
 
-        #Check if file allready exists in folder:
-        files = os.listdir(path)
-        dupCount = 1
-        #Check for duplicates of both txt and xml files, incase there is need
-        #for a copy of the xml as well.
-        while filename in files:
-            dupCount += 1
-            filename = '%s (%d).%s' % (name, dupCount,extension)
+        def incremented(dupCount):
+            if dupCount == 1:
+                return filename
+            return '%s (%d).%s' % (name, dupCount,extension)
 
-        return filename
+        def exists(dupCount):
+            return os.path.exists(os.path.join(path, incremented(dupCount)))
 
-    def _compileLogText_(self,title):
-        #Compile log text. Create a single string from the entire batch of
-        #messages and errors added to the message handler object.
+        key = (os.path.abspath(path), filename)
+        dupCount = _nameIncrements_.get(key)
+        if dupCount is None or not exists(1):
+            #Find the first free increment. lower exists, upper does not:
+            if not exists(1):
+                dupCount = 1
+            else:
+                lower, upper = 1, 2
+                while exists(upper):
+                    lower, upper = upper, upper * 2
+                while upper - lower > 1:
+                    middle = (lower + upper) // 2
+                    if exists(middle):
+                        lower = middle
+                    else:
+                        upper = middle
+                dupCount = upper
+
+        #Reserve the name. Another process may have taken it in the meantime:
+        while True:
+            try:
+                os.close(os.open(os.path.join(path, incremented(dupCount)), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                dupCount += 1
+
+        _nameIncrements_[key] = dupCount + 1
+        return incremented(dupCount)
+
+    def _logHeader_(self, title):
+        #Title block and start time that open the log text.
         logText = ''
         stringLen = len(title)
         logText += '%s\n' % ('-' * (stringLen + 8))
         logText += '--- %s %s\n' % (title, '---')
         logText += '%s\n' % ('-' * (stringLen + 8))
-        logText += '%s = %s' % ('Run start time', self.init.strftime('%Y.%m.%d %H:%M:%S'))
-
-        #Add all logged messages:
-        for message in self.m:
-            logText += message.getMessage()
+        logText += '%s = %s' % ('Run start time', _timestampCache.stamp(self.init.timestamp()))
+        return logText
 
-        #Complete file, aka add summery text:
+    def _logFooter_(self):
+        #Summary text that closes the log text.
+        logText = ''
         logText += '\n\nRun complete.'
         logText += '\nNumber of warning messages logged: %d' % self.warningCount
         logText += '\nNumber of error messages logged: %d' % self.errorCount
+        if isinstance(self.m, BoundedMessageStore):
+            logText += '\nNumber of messages suppressed: %d (%d repeats collapsed, %d dropped from memory)' % (
+                self.m.suppressed, self.m.collapsed, self.m.dropped)
         logText += '\nEnd of file.'
+        return logText
+
+    def _compileLogText_(self,title):
+        #Compile log text. Create a single string from the entire batch of
+        #messages and errors added to the message handler object.
+        logText = ''.join(self.iter_log_lines(title))
 
         try:
             logText = logText.decode('utf-8')
         except:
             pass
 
-        return logText
\ No newline at end of file
+        return logText
+
+
+class QueueSink(object):
+    # Worker side sink for multi-process logging. Sends compact
+    # (epoch, flags, text) tuples in batches over a multiprocessing queue to a
+    # LogCollector in the parent process. Batches are sent when batchSize
+    # records are buffered, when flushInterval milliseconds have passed since
+    # the last send (checked on write), on errors and on flush/close.
+
+    def __init__(self, queue, workerId=None, batchSize=1000, flushInterval=200):
+        # Input:
+        #       queue           multiprocessing.Queue, Queue of the collector.
+        #       workerId        Id added to the messages of this worker.
+        #                       Defaults to the process id.
+        #       batchSize       int, Number of records per batch.
+        #       flushInterval   int, Milliseconds between sends. None
+        #                            disables time based sending.
+        if workerId is None:
+            workerId = os.getpid()
+        self.queue = queue
+        self.workerId = workerId
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self._batch_ = []
+        self._lastFlush_ = default_timer()
+
+    def open(self, log, title):
+        pass
+
+    def write(self, message):
+        batch = self._batch_
+        batch.append((message.epoch, message.flags(), message.text))
+        if len(batch) >= self.batchSize or message.error:
+            self.flush()
+        elif self.flushInterval is not None:
+            if (default_timer() - self._lastFlush_) * 1000 >= self.flushInterval:
+                self.flush()
+
+    def flush(self):
+        # Send the buffered records.
+        if self._batch_:
+            self.queue.put(('batch', self.workerId, self._batch_))
+            self._batch_ = []
+        self._lastFlush_ = default_timer()
+
+    def close(self, log):
+        # Send the remaining records and tell the collector this worker is
+        # done.
+        self.flush()
+        self.queue.put(('close', self.workerId, None))
+
+
+class LogCollector(object):
+    # Parent side of multi-process logging. A thread receives record batches
+    # from QueueSinks in worker processes and writes them to log in timestamp
+    # order, with the worker id in front of the text. Error and warning counts
+    # are added to the log and kept per worker in workerCounts.
+    #
+    # Records are held back until they are maxDelay seconds old, or, when the
+    # number of workers is given, until every open worker has sent something
+    # newer. Records arriving later than that are written as they come, so a
+    # worker should not sit on a partial batch for longer than maxDelay. They
+    # keep their epochs, and are stored in time order by the log.
+    #
+    # Typical use with a process pool:
+    #
+    #   collector = LogCollector(log)
+    #   with ProcessPoolExecutor(8, initializer=initWorker, initargs=(collector.queue,)) as pool:
+    #       ...  # tasks log through workerLog()
+    #   collector.close()
+
+    def __init__(self, log, queue=None, maxDelay=1.0, workers=None):
+        # Input:
+        #       log             Log, The log to collect into.
+        #       queue           Queue to receive on. Defaults to a new
+        #                       multiprocessing.Queue.
+        #       maxDelay        float, Seconds a record can be held back
+        #                              waiting for other workers.
+        #       workers         int, Number of worker processes, if known.
+        self.log = log
+        self.queue = queue if queue is not None else multiprocessing.Queue()
+        self.maxDelay = maxDelay
+        self.workers = workers
+        self.workerCounts = {}
+        self._pending_ = {}
+        self._latest_ = {}
+        self.thread = threading.Thread(target=self._run_, name='LogCollector', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # Write all held back records and stop the collector. Call after the
+        # workers have finished and flushed their logs.
+        if self.thread.is_alive():
+            self.queue.put(('stop', None, None))
+            self.thread.join()
+
+    def _run_(self):
+        get = self.queue.get
+        while True:
+            try:
+                kind, workerId, batch = get(timeout=self.maxDelay)
+            except Empty:
+                # Nothing new, release what has waited long enough:
+                self._release_(epochTime() - self.maxDelay)
+                continue
+
+            if kind == 'stop':
+                self._release_(None)
+                return
+
+            pending = self._pending_.setdefault(workerId, deque())
+            counts = self.workerCounts.setdefault(workerId, [0, 0])
+            if kind == 'batch':
+                for epoch, flags, text in batch:
+                    pending.append((epoch, flags, text))
+                    if flags & ERROR:
+                        counts[0] += 1
+                    elif flags & WARNING:
+                        counts[1] += 1
+                self._latest_[workerId] = batch[-1][0]
+            else:
+                self._latest_.pop(workerId, None)
+
+            watermark = epochTime() - self.maxDelay
+            if self.workers and len(self.workerCounts) >= self.workers:
+                if not self._latest_:
+                    watermark = None
+                else:
+                    watermark = max(min(self._latest_.values()), watermark)
+            self._release_(watermark)
+
+    def _release_(self, watermark):
+        # Merge and write all pending records up to watermark epoch seconds.
+        # None releases everything.
+        ready = []
+        for workerId, pending in self._pending_.items():
+            records = []
+            while pending and (watermark is None or pending[0][0] <= watermark):
+                epoch, flags, text = pending.popleft()
+                records.append((epoch, flags, text, workerId))
+            if records:
+                ready.append(records)
+        if not ready:
+            return
+
+        # Written through the writer of an asynchronous log, and otherwise
+        # under the log lock, since the parent may log at the same time:
+        log = self.log
+        lines = []
+        for epoch, flags, text, workerId in heapq.merge(*ready, key=lambda record: record[0]):
+            if isinstance(text, list):
+                text = ['[%s] %s' % (workerId, item) for item in text]
+            else:
+                text = '[%s] %s' % (workerId, text)
+            with log._lock_:
+                log._count_(flags)
+                writer = log.writer
+                if writer is None:
+                    line = log._writeLocked_(epoch, text, flags, False)
+                    if line is not None:
+                        lines.append(line)
+            if writer is not None:
+                writer.put((epoch, text, flags, False))
+        if lines:
+            print('\n'.join(lines))
+
+    @property
+    def errorCount(self):
+        # Errors received from all workers.
+        return sum(counts[0] for counts in self.workerCounts.values())
+
+    @property
+    def warningCount(self):
+        # Warnings received from all workers.
+        return sum(counts[1] for counts in self.workerCounts.values())
+
+
+_workerLog_ = None
+
+
+def initWorker(queue, workerId=None, batchSize=1000, flushInterval=200, timestamp=True):
+    # Process pool initializer. Creates the log of this worker process, which
+    # sends its messages to the LogCollector owning queue, and closes it when
+    # the process exits. Tasks get the log with workerLog().
+    global _workerLog_
+    _workerLog_ = Log(timestamp=timestamp)
+    _workerLog_.keepMessages = False
+    _workerLog_.addSink(QueueSink(queue, workerId, batchSize, flushInterval))
+    # Runs before the queue's own exit finalizers, which have priority 10:
+    Finalize(_workerLog_, _workerLog_.close, exitpriority=20)
+    return _workerLog_
+
+
+def workerLog():
+    # The log of this worker process, see initWorker.
+    return _workerLog_
@@ -1,7 +1,8 @@
 
 # Test primary modules:
-from tests import test_simpletimer, test_tregex, test_logger
+from tests import test_simpletimer, test_tregex, test_logger, test_tracer
 test_simpletimer.run()
 test_tregex.run()
 test_logger.run()
+test_tracer.run()
 
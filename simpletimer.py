@@ -11,39 +11,127 @@ from __future__ import unicode_literals
 # Licence:     <your licence>
 #-------------------------------------------------------------------------------
 
-import datetime
 import time
 import math
 import warnings
+import statistics
+import sys
+import os
+from collections import Counter
+import asyncio
+import functools
+import threading
+import multiprocessing
+from multiprocessing.util import Finalize
+from array import array
+
+ESTIMATORS = ('window', 'ewma', 'median')
+
 
 class ProgressTimer(object):
-    def __init__(self, total_count, message='', sample_size=None):
+    def __init__(self, total_count, message='', sample_size=None, estimator='window', smoothing=0.1,
+                 median_window=31, tracer=None):
         """Class for printing percentage progress and completion time estimates.
 
         total_count -- int, the total amount of iterations
         message -- str, the standard message printed at call to the ProgressTimer
         sample_size -- int, with a very large iteration set, set a fixed amount of iterations to estimate ETA over.
+        estimator -- str, how calculate_sample estimates the time per iteration:
+            'window': average over the last sample_size iterations, kept in a preallocated ring buffer.
+            'ewma': exponentially weighted moving average of the time per iteration, weighted by smoothing.
+            'median': median time per iteration of the last median_window calls, robust to single slow iterations.
+        smoothing -- float, weight of the newest iteration in the 'ewma' estimator.
+        median_window -- int, number of calls the 'median' estimator takes the median over.
+        tracer -- tracer.Tracer, records each progress calculation as a counter event.
         """
 
         assert isinstance(total_count, int)
         assert isinstance(sample_size, (type(None), int))
         assert isinstance(message, str)
+        assert estimator in ESTIMATORS
 
         if sample_size and sample_size/total_count > 0.7 and total_count > 100:
             warnings.warn('Progress timer sample_size is 0.7 if total item count. Revise for speed.')
 
         self.total_count = total_count
         self.message = message
-        self.time_start = time.clock()
+        self.time_start = time.perf_counter()
 
         if not sample_size:
             sample_size = total_count
 
         self.sample_size = sample_size
-        self.time_sample = []
+        self.estimator = estimator
+        self.smoothing = smoothing
+        self.median_window = median_window
+        self.tracer = tracer
+
+        # Ring buffers of time and count per call, allocated on first use:
+        self._ring_times = None
+        self._ring_counts = None
+        self._ring_index = 0
+        self._ring_filled = 0
+        self._last_time = None
+        self._last_count = 0
+        self._per_item = None
+        self._eta_minute = None
+        self._oclock = ''
 
         self.count = 0
 
+    @property
+    def time_sample(self):
+        """The sampled times, oldest first."""
+        if self._ring_times is None:
+            return []
+        size = len(self._ring_times)
+        first = (self._ring_index - self._ring_filled) % size
+        return [self._ring_times[(first + i) % size] for i in range(self._ring_filled)]
+
+    def _update_estimate(self, current_time):
+        """Add the current time and count to the estimator and return the estimated seconds per iteration, or None
+        while there is too little data. O(1) for 'window' and 'ewma', O(median_window) for 'median'."""
+        count = self.count
+
+        if self.estimator == 'ewma':
+            if self._last_time is not None and count > self._last_count:
+                per_item = (current_time - self._last_time)/(count - self._last_count)
+                if self._per_item is None:
+                    self._per_item = per_item
+                else:
+                    self._per_item += self.smoothing*(per_item - self._per_item)
+            self._last_time, self._last_count = current_time, count
+            return self._per_item
+
+        if self.estimator == 'median':
+            if self._ring_times is None:
+                self._ring_times = array('d', [0.0])*self.median_window
+            if self._last_time is not None and count > self._last_count:
+                self._ring_times[self._ring_index] = (current_time - self._last_time)/(count - self._last_count)
+                self._ring_index = (self._ring_index + 1) % self.median_window
+                self._ring_filled = min(self._ring_filled + 1, self.median_window)
+            self._last_time, self._last_count = current_time, count
+            if not self._ring_filled:
+                return None
+            return statistics.median(self._ring_times[:self._ring_filled])
+
+        # Sliding window over a ring buffer. The oldest slot is overwritten once it is full:
+        if self._ring_times is None:
+            self._ring_times = array('d', [0.0])*self.sample_size
+            self._ring_counts = array('d', [0.0])*self.sample_size
+        size = self.sample_size
+        index = self._ring_index
+        self._ring_times[index] = current_time
+        self._ring_counts[index] = count
+        self._ring_index = (index + 1) % size
+        if self._ring_filled < size:
+            self._ring_filled += 1
+        oldest = (self._ring_index - self._ring_filled) % size
+        counted = count - self._ring_counts[oldest]
+        if counted <= 0:
+            return None
+        return (current_time - self._ring_times[oldest])/counted
+
     def __str__(self):
         return self.string()
 
@@ -51,11 +139,9 @@ class ProgressTimer(object):
         """Return the percentage of completion along with the hours, minutes and seconds until completion. Calculated
         based on a subset of iterations.
 
-        Based on elapsed time compared to total number of iterations and the executed iterations:
+        Based on the time per iteration from the estimator (see __init__) and the remaining iterations:
 
-        count/total_count = time_passed/total_time
-        total_time = count/(total_count * time_passed)
-        time_left = total_time - time_passed
+        time_left = time_per_iteration * (total_count - count)
 
         If count is not specified, automatically increment by 1.
         """
@@ -64,22 +150,20 @@ class ProgressTimer(object):
             self.count += 1
         else:
             self.count = count
-        self.count += 1
-        current_time = time.clock()
+        current_time = time.perf_counter()
 
-        # Keep the current time for samples up to the sample size:
-        if len(self.time_sample) < self.sample_size:
-            self.time_sample += [current_time]
-        else:
-            self.time_sample.pop(0)
-            self.time_sample += [current_time]
+        per_item = self._update_estimate(current_time)
+        if per_item is None:
+            # Not enough samples yet, fall back on the average since start:
+            per_item = (current_time - self.time_start)/self.count
 
-        time_sample = self.time_sample[-1] - self.time_sample[0]
-        time_past = current_time - self.time_start
-        time_left = time_sample*self.total_count/len(self.time_sample)-time_past  # Assumes time_past/total_time == count/total_count
+        time_left = per_item*(self.total_count - self.count)
 
         time_left = max([time_left, 0])
 
+        if self.tracer is not None:
+            self.tracer.counter(self.message or 'progress', count=self.count, seconds_left=time_left)
+
         hours = int(time_left/3600)
         minutes = int((time_left-hours*3600)/60)
         seconds = int(math.fmod(time_left, 60))
@@ -112,7 +196,7 @@ class ProgressTimer(object):
             minutes = 0
             seconds = 0
         else:
-            current_time = time.clock()
+            current_time = time.perf_counter()
 
             time_past = current_time-self.time_start
             time_left = time_past*self.total_count/self.count-time_past  # Assumes time_past/total_time == count/total_count
@@ -125,6 +209,9 @@ class ProgressTimer(object):
 
             percentage = self.count/self.total_count*100
 
+            if self.tracer is not None:
+                self.tracer.counter(self.message or 'progress', count=self.count, seconds_left=time_left)
+
         return percentage, hours, minutes, seconds
 
     def string(self, message='', count=None):
@@ -139,18 +226,26 @@ class ProgressTimer(object):
         if message:
             message += ': '
 
-        if self.sample_size != self.total_count:
+        if self.sample_size != self.total_count or self.estimator != 'window':
             percentage, hours, minutes, seconds = self.calculate_sample(count)
         else:
             percentage, hours, minutes, seconds = self.calculate(count)
 
         percentage = round(percentage)  # Round so decimals are not just cropped.
 
-        time = datetime.datetime.now() + datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
-        oclock = time.strftime('%H:%M')
+        # The clock time of the ETA only changes once a minute, so format it once a minute:
+        eta_minute = int((time.time() + hours*3600 + minutes*60 + seconds)//60)
+        if eta_minute != self._eta_minute:
+            self._eta_minute = eta_minute
+            self._oclock = time.strftime('%H:%M', time.localtime(eta_minute*60))
+        oclock = self._oclock
 
         return '%(message)s%(percentage)3d%%: ETA in: %(hours)3dh %(minutes)2dm %(seconds)2.0ds (%(oclock)s)' % locals()
 
+    def update(self, n=1):
+        """Count n more items without calculating or printing, e.g. for a ProgressDashboard."""
+        self.count += n
+
     def print(self, message='', count=None):
         """Print the current string representation of progress. If count is not specified, automatically increment by
         1."""
@@ -158,15 +253,684 @@ class ProgressTimer(object):
         assert isinstance(message, str)
         print(self.string(message, count))
 
+    def wrap(self, iterable, message='', min_interval=0.1, min_iters=1, file=None):
+        """Yield the items of iterable and print the progress at most every min_interval seconds, plus once at the
+        end.
+
+        Between renders, an item only costs a counter increment and a comparison. The clock is read every min_iters
+        items, and min_iters adapts to the observed rate so the clock is read about once per min_interval (like
+        miniters in tqdm).
+
+        message -- str, message of the printed progress. Defaults to the message of the timer.
+        min_interval -- float, minimum seconds between renders.
+        min_iters -- int, initial number of items between clock reads.
+        file -- file object to print to, default stdout.
+        """
+        perf_counter = time.perf_counter
+        count = self.count
+        next_check = count + min_iters
+        last_render = perf_counter()
+        last_count = count
+
+        for item in iterable:
+            yield item
+            count += 1
+            if count >= next_check:
+                now = perf_counter()
+                elapsed = now - last_render
+                if elapsed >= min_interval:
+                    print(self.string(message, count), file=file)
+                    # Aim the next clock read at min_interval from now:
+                    min_iters = max(1, int((count - last_count)*min_interval/elapsed))
+                    last_render, last_count = now, count
+                elif elapsed > 0:
+                    # Early. Wait for as many items as should fill the rest of min_interval:
+                    min_iters = max(1, int((count - last_count)*(min_interval - elapsed)/elapsed))
+                else:
+                    min_iters *= 2
+                next_check = count + min_iters
+
+        self.count = count
+        print(self.string(message, count), file=file)
+
+    track = wrap
+
+    async def awrap(self, aiterable, message='', interval=0.5, file=None):
+        """Async version of wrap. Yield the items of the async iterable aiterable, counting each. The progress is
+        printed every interval seconds by a single render task, and once at the end. Printing runs in the default
+        executor, so a slow stdout does not block the event loop.
+
+        message -- str, message of the printed progress. Defaults to the message of the timer.
+        interval -- float, seconds between renders.
+        file -- file object to print to, default stdout.
+        """
+        # The item count is kept apart from self.count, which rendering sets, as in wrap:
+        counter = [self.count]
+        renderer = asyncio.ensure_future(self._render_periodically(message, interval, file, counter))
+        try:
+            async for item in aiterable:
+                counter[0] += 1
+                yield item
+        finally:
+            renderer.cancel()
+            try:
+                await renderer
+            except asyncio.CancelledError:
+                pass
+            self.count = counter[0]
+            print(self.string(message, self.count), file=file)
+
+    async def track_tasks(self, awaitables, message='', interval=0.5, file=None):
+        """Yield the results of awaitables in order of completion, counting each completed task. The ETA follows the
+        task completion rate. See awrap for message, interval and file."""
+        async def completed():
+            for future in asyncio.as_completed(awaitables):
+                yield await future
+
+        async for result in self.awrap(completed(), message, interval, file):
+            yield result
+
+    async def _render_periodically(self, message, interval, file, counter):
+        loop = asyncio.get_running_loop()
+        last_line = None
+        while True:
+            await asyncio.sleep(interval)
+            line = self.string(message, counter[0])
+            if line != last_line:
+                await loop.run_in_executor(None, functools.partial(print, line, file=file))
+                last_line = line
+
+
+    def attach_sampler(self, log, **kwargs):
+        """Start and return a SlowIterationSampler of this timer, warning to the logger.Log log. See
+        SlowIterationSampler for kwargs."""
+        sampler = SlowIterationSampler(self, log, **kwargs)
+        sampler.start()
+        return sampler
+
+
+class SlowIterationSampler(object):
+    def __init__(self, timer, log, interval=0.01, window=1.0, threshold=0.5, smoothing=0.3, top=10, depth=30,
+                 max_overhead=0.02, thread_id=None):
+        """Sampling profiler tied to a ProgressTimer. A background thread samples the stack of the looping thread with
+        sys._current_frames every interval seconds. Every window seconds the iteration rate of the window is compared
+        with the baseline, a moving average of earlier windows. When the rate is below threshold times the baseline,
+        the hottest frames of the window are written to log as a warning.
+
+        The baseline is kept by the sampler rather than taken from the estimator of the timer. The estimator is only
+        updated when the timer is rendered, which a loop may do rarely or never, and it follows the slowdown itself.
+        Slow windows are left out of the baseline, so a long slow stretch keeps being reported against the rate
+        before it.
+
+        The time spent sampling is measured in overhead (seconds). When it exceeds max_overhead as a fraction of a
+        window, the sampling interval is doubled, and when it falls below a quarter of that, the interval is halved
+        again, down to the interval given.
+
+        timer -- ProgressTimer, the timer whose count is followed.
+        log -- logger.Log, receives the warnings.
+        interval -- float, seconds between stack samples.
+        window -- float, seconds per rate comparison.
+        threshold -- float, fraction of the baseline rate below which a window is slow.
+        smoothing -- float, weight of the newest normal window in the baseline.
+        top -- int, number of hot frames in a warning.
+        depth -- int, maximum number of frames walked per sample.
+        max_overhead -- float, maximum fraction of time spent sampling.
+        thread_id -- int, ident of the thread to sample. Defaults to the thread creating the sampler.
+        """
+        self.timer = timer
+        self.log = log
+        self.base_interval = self.interval = interval
+        self.window = window
+        self.threshold = threshold
+        self.smoothing = smoothing
+        self.top = top
+        self.depth = depth
+        self.max_overhead = max_overhead
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+
+        self.baseline = None
+        self.slow_windows = 0
+        self.samples = 0
+        self.overhead = 0.0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._reset_window(time.perf_counter())
+
+    @property
+    def overhead_fraction(self):
+        """Fraction of the elapsed time spent sampling."""
+        if self.started is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.started
+        return self.overhead/elapsed if elapsed > 0 else 0.0
+
+    def start(self):
+        if self._thread is None:
+            self.started = time.perf_counter()
+            self._reset_window(self.started)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='SlowIterationSampler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _reset_window(self, now):
+        self._frames = Counter()
+        self._window_samples = 0
+        self._window_overhead = 0.0
+        self._window_start = now
+        self._window_count = self.timer.count
+
+    def sample(self):
+        """Add the current stack of the sampled thread to the window."""
+        frame = sys._current_frames().get(self.thread_id)
+        frames = self._frames
+        seen = set()
+        depth = 0
+        while frame is not None and depth < self.depth:
+            code = frame.f_code
+            key = (code.co_filename, frame.f_lineno, code.co_name)
+            if key not in seen:  # Count recursive frames once per sample.
+                seen.add(key)
+                frames[key] += 1
+            frame = frame.f_back
+            depth += 1
+        self._window_samples += 1
+        self.samples += 1
+
+    def check(self, now=None):
+        """End the window if window seconds have passed at now (perf_counter seconds): compare its rate with the
+        baseline, warn if it is slow and adapt the sampling interval to the overhead. Returns True for a slow
+        window."""
+        if now is None:
+            now = time.perf_counter()
+        seconds = now - self._window_start
+        if seconds < self.window:
+            return False
+
+        self._adapt_interval(self._window_overhead/seconds)
+        rate = (self.timer.count - self._window_count)/seconds
+        slow = self.baseline is not None and rate < self.threshold*self.baseline
+        if slow:
+            self.slow_windows += 1
+            self._warn(rate, seconds, self._frames, self._window_samples)
+        elif self.baseline is None:
+            self.baseline = rate
+        else:
+            self.baseline += self.smoothing*(rate - self.baseline)
+        self._reset_window(now)
+        return slow
+
+    def _adapt_interval(self, fraction):
+        """Double the interval when fraction of the time was spent sampling above max_overhead, and halve it towards
+        the interval given when the overhead is well below."""
+        if fraction > self.max_overhead:
+            self.interval *= 2
+        elif fraction < self.max_overhead/4 and self.interval > self.base_interval:
+            self.interval = max(self.interval/2, self.base_interval)
+
+    def _run(self):
+        perf_counter = time.perf_counter
+        while not self._stop.wait(self.interval):
+            before = perf_counter()
+            self.sample()
+            spent = perf_counter() - before
+            self.overhead += spent
+            self._window_overhead += spent
+            self.check()
+
+    def _warn(self, rate, seconds, frames, samples):
+        # Log.addWarning is safe to call from this thread, since the log writes under its lock.
+        lines = ['Slow iterations in %s: %.1f/s against a baseline of %.1f/s over the last %.1f s. Hot frames of %d '
+                 'samples:' % (self.timer.message or 'progress', rate, self.baseline, seconds, samples)]
+        for (filename, lineno, name), count in frames.most_common(self.top):
+            lines.append('  %3d%% %s:%d in %s' % (100*count/max(samples, 1), os.path.basename(filename), lineno,
+                                                  name))
+        self.log.addWarning(lines)
+
+
+def track(iterable, message='', total_count=None, **kwargs):
+    """Yield the items of iterable while printing progress, see ProgressTimer.wrap. total_count defaults to
+    len(iterable)."""
+    if total_count is None:
+        total_count = len(iterable)
+    return ProgressTimer(total_count, message).wrap(iterable, **kwargs)
+
+
+def track_tasks(awaitables, message='', **kwargs):
+    """Async generator of the results of awaitables in order of completion, printing progress. See
+    ProgressTimer.track_tasks."""
+    awaitables = list(awaitables)
+    return ProgressTimer(len(awaitables), message).track_tasks(awaitables, **kwargs)
+
+
+class ProgressCounter(object):
+    def __init__(self, shared_count, batch_size=1000, batch_interval=0.1):
+        """Batched incrementer of a shared count. Increments are added up locally and only added to the shared count,
+        under its lock, every batch_size items or batch_interval seconds, so many threads or processes can report
+        progress without contending for the lock. Call flush() when done, or use as a context manager.
+
+        shared_count -- multiprocessing.Value, the shared count.
+        batch_size -- int, items counted locally before the shared count is updated.
+        batch_interval -- float, maximum seconds an update is held back, checked on update.
+        """
+        self.shared_count = shared_count
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.local = 0
+        self.deadline = time.perf_counter() + batch_interval
+
+    def update(self, n=1):
+        """Count n more items."""
+        self.local += n
+        if self.local >= self.batch_size or time.perf_counter() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        """Add the locally counted items to the shared count."""
+        if self.local:
+            with self.shared_count.get_lock():
+                self.shared_count.value += self.local
+            self.local = 0
+        self.deadline = time.perf_counter() + self.batch_interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+class SharedProgressTimer(ProgressTimer):
+    def __init__(self, total_count, message='', batch_size=1000, batch_interval=0.1, **kwargs):
+        """ProgressTimer advanced by many threads or processes through a shared count in shared memory.
+
+        Threads call update(n), which counts through a ProgressCounter per thread. Process pool workers are set up with
+        init_progress_worker(timer.shared_count) as initializer and count through progress_counter(). The progress is
+        shown by one renderer, see start_render, with the aggregate throughput and ETA.
+
+        total_count, message -- see ProgressTimer.
+        batch_size, batch_interval -- batching of the counters, see ProgressCounter.
+        kwargs -- further ProgressTimer arguments.
+        """
+        ProgressTimer.__init__(self, total_count, message, **kwargs)
+        self.shared_count = multiprocessing.Value('q', 0)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._local = threading.local()
+        self._counters = []
+        self._counters_lock = threading.Lock()
+        self._render_thread = None
+        self._render_stop = threading.Event()
+
+    def counter(self):
+        """Return a new ProgressCounter of the shared count."""
+        return ProgressCounter(self.shared_count, self.batch_size, self.batch_interval)
+
+    def update(self, n=1):
+        """Count n more items from the calling thread."""
+        try:
+            counter = self._local.counter
+        except AttributeError:
+            counter = self._local.counter = self.counter()
+            with self._counters_lock:
+                self._counters.append(counter)
+        counter.update(n)
+
+    def flush(self):
+        """Add the counts held back by the threads of this process to the shared count. Call when the threads are
+        done."""
+        with self._counters_lock:
+            for counter in self._counters:
+                counter.flush()
+
+    @property
+    def shared_value(self):
+        """The count reported so far by all threads and processes."""
+        return self.shared_count.value
+
+    def string(self, message='', count=None):
+        """Return the string representation of the aggregate progress, with throughput."""
+        if count is None:
+            count = self.shared_value
+        line = ProgressTimer.string(self, message, count)
+        elapsed = time.perf_counter() - self.time_start
+        rate = count/elapsed if elapsed > 0 else 0.0
+        return '%s %.0f/s' % (line, rate)
+
+    def start_render(self, interval=0.5, file=None):
+        """Print the aggregate progress every interval seconds from a background thread until stop_render."""
+        if self._render_thread is not None:
+            return
+        self._render_stop.clear()
+
+        def render():
+            while not self._render_stop.wait(interval):
+                print(self.string(), file=file)
+
+        self._render_thread = threading.Thread(target=render, name='ProgressRender', daemon=True)
+        self._render_thread.start()
+
+    def stop_render(self, file=None):
+        """Stop the renderer and print the final progress."""
+        if self._render_thread is None:
+            return
+        self._render_stop.set()
+        self._render_thread.join()
+        self._render_thread = None
+        self.flush()
+        print(self.string(), file=file)
+
+
+_worker_counter = None
+
+
+def init_progress_worker(shared_count, batch_size=1000, batch_interval=0.1):
+    """Process pool initializer for SharedProgressTimer. Pass timer.shared_count. Tasks count with progress_counter(),
+    which is flushed when the worker process exits."""
+    global _worker_counter
+    _worker_counter = ProgressCounter(shared_count, batch_size, batch_interval)
+    Finalize(_worker_counter, _worker_counter.flush, exitpriority=20)
+    return _worker_counter
+
+
+def progress_counter():
+    """The ProgressCounter of this worker process, see init_progress_worker."""
+    return _worker_counter
+
+
+class ProgressDashboard(object):
+    def __init__(self, fps=10, file=None, summary_interval=10.0, smoothing=0.3, width=30):
+        """One consolidated view of many ProgressTimers, drawn by a single render thread at a fixed frame rate.
+
+        Jobs count with timer.update(n) and never print. On a terminal, every frame redraws the view in place with
+        ANSI cursor control. Otherwise a plain summary is written every summary_interval seconds. Each frame is one
+        string written with a single write call, and shows the progress, throughput and ETA of every job.
+
+        fps -- float, frames per second.
+        file -- text file, defaults to sys.stdout.
+        summary_interval -- float, seconds between summaries when file is not a terminal.
+        smoothing -- float, weight of the newest frame in the moving average of each job's throughput.
+        width -- int, width of the job name column.
+        """
+        self.interval = 1/fps
+        self.file = file
+        self.summary_interval = summary_interval
+        self.smoothing = smoothing
+        self.width = width
+        self.timers = []
+        self.frames = 0
+        self._rates = []
+        self._last = []
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, total_count, message='', **kwargs):
+        """Create, add and return a ProgressTimer. kwargs are passed on to ProgressTimer."""
+        return self.add_timer(ProgressTimer(total_count, message, **kwargs))
+
+    def add_timer(self, timer):
+        """Add an existing ProgressTimer or SharedProgressTimer and return it."""
+        with self._lock:
+            self.timers.append(timer)
+            self._rates.append(None)
+            self._last.append((time.perf_counter(), self._count(timer)))
+        return timer
+
+    @staticmethod
+    def _count(timer):
+        if isinstance(timer, SharedProgressTimer):
+            return timer.shared_value
+        return timer.count
+
+    def _file(self):
+        return self.file if self.file is not None else sys.stdout
+
+    def _is_terminal(self):
+        isatty = getattr(self._file(), 'isatty', None)
+        return bool(isatty and isatty())
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ProgressDashboard', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the render thread and draw the final frame."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._write(self.frame(self._is_terminal()))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        terminal = self._is_terminal()
+        next_summary = time.perf_counter() + self.summary_interval
+        while not self._stop.wait(self.interval):
+            if terminal:
+                self._write(self.frame(True))
+            elif time.perf_counter() >= next_summary:
+                self._write(self.frame(False))
+                next_summary += self.summary_interval
+            else:
+                self._measure()
+
+    def _measure(self):
+        """Update the throughput of every job and return the (timer, count, rate) of each."""
+        now = time.perf_counter()
+        jobs = []
+        with self._lock:
+            for i, timer in enumerate(self.timers):
+                count = self._count(timer)
+                last_time, last_count = self._last[i]
+                if now > last_time:
+                    rate = (count - last_count)/(now - last_time)
+                    if self._rates[i] is None:
+                        self._rates[i] = rate
+                    else:
+                        self._rates[i] += self.smoothing*(rate - self._rates[i])
+                    self._last[i] = (now, count)
+                jobs.append((timer, count, self._rates[i] or 0.0))
+        return jobs
+
+    def _line(self, timer, count, rate):
+        name = (timer.message or 'job')[:self.width]
+        total = timer.total_count
+        percentage = 100*count/total if total else 100
+        if count >= total:
+            eta = 'done in %.1f s' % (time.perf_counter() - timer.time_start)
+        elif rate > 0:
+            time_left = (total - count)/rate
+            hours = int(time_left/3600)
+            minutes = int((time_left - hours*3600)/60)
+            seconds = int(math.fmod(time_left, 60))
+            eta = 'ETA in: %3dh %2dm %2ds' % (hours, minutes, seconds)
+        else:
+            eta = 'ETA in: -'
+        return '%-*s %3d%% %12d/%-12d %10.0f/s %s' % (self.width, name, percentage, count, total, rate, eta)
+
+    def frame(self, terminal=False):
+        """Return the text of the next frame. On a terminal, the frame moves the cursor back over the previous one
+        and overwrites it."""
+        jobs = self._measure()
+        done = sum(count >= timer.total_count for timer, count, rate in jobs)
+        lines = ['%d jobs, %d done, %.0f/s in total' % (len(jobs), done, sum(rate for timer, count, rate in jobs))]
+        lines += [self._line(*job) for job in jobs]
+        self.frames += 1
+        if not terminal:
+            return '\n'.join(lines) + '\n'
+
+        # Move up to the first line of the previous frame, clear each line before drawing it, and clear what is left
+        # below when the frame got shorter:
+        up = '\x1b[%dF' % self._lines if self._lines else ''
+        self._lines = len(lines)
+        return up + ''.join('%s\x1b[K\n' % line for line in lines) + '\x1b[J'
+
+    def _write(self, text):
+        """Write text with one write call, past the buffering of the file when it has a file descriptor."""
+        file = self._file()
+        try:
+            fd = file.fileno()
+        except (AttributeError, OSError, ValueError):
+            file.write(text)
+            file.flush()
+            return
+        file.flush()
+        data = text.encode(getattr(file, 'encoding', None) or 'utf-8', 'replace')
+        while data:
+            data = data[os.write(fd, data):]
+
+
+class LatencyHistogram(object):
+    def __init__(self, precision=7):
+        """Streaming histogram of non-negative integer values, e.g. latencies in nanoseconds, for percentiles in fixed
+        memory. Values are counted in log-linear buckets like an HDR histogram: exact below 2**(precision + 1), above
+        that 2**precision buckets per power of two, so any percentile is within a relative error of 2**-precision.
+        Memory depends on the largest value only, at most 8*(65 - precision)*2**precision bytes.
+
+        Histograms of the same precision can be merged, e.g. from several threads or processes, and are serialized
+        with to_dict/from_dict.
+
+        precision -- int, bits of precision per power of two.
+        """
+        self.precision = precision
+        self.counts = array('Q')
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision - 1
+        if shift <= 0:
+            return value
+        return (shift << self.precision) + (value >> shift)
+
+    def _bucket(self, index):
+        """Return the lowest value and width of the bucket at index."""
+        limit = 2 << self.precision
+        if index < limit:
+            return index, 1
+        shift = (index >> self.precision) - 1
+        top = index - (shift << self.precision)
+        return top << shift, 1 << shift
+
+    def record(self, value, n=1):
+        """Count value n times."""
+        value = int(value)
+        if value < 0:
+            raise ValueError('LatencyHistogram values must be non-negative.')
+        index = self._index(value)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend(bytes(8*(index + 1 - len(counts))))
+        counts[index] += n
+        self.count += n
+        self.total += value*n
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the counts of another histogram of the same precision."""
+        if other.precision != self.precision:
+            raise ValueError('Only histograms of the same precision can be merged.')
+        if len(other.counts) > len(self.counts):
+            self.counts.extend(bytes(8*(len(other.counts) - len(self.counts))))
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total/self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """Return the value at quantile q (0 to 1), as the middle of its bucket, limited to the recorded min and
+        max."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q*self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                low, width = self._bucket(index)
+                return min(max(low + (width - 1)/2, self.min), self.max)
+        return float(self.max)
+
+    def percentiles(self, percents=(50, 95, 99, 99.9)):
+        """Return a dict of percent to value."""
+        return dict((percent, self.quantile(percent/100)) for percent in percents)
+
+    def to_dict(self):
+        """Return the histogram as a dict of plain values, with the counts stored sparsely."""
+        return {'precision': self.precision, 'count': self.count, 'total': self.total, 'min': self.min,
+                'max': self.max, 'counts': [[index, count] for index, count in enumerate(self.counts) if count]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a histogram from to_dict output."""
+        histogram = cls(data['precision'])
+        for index, count in data['counts']:
+            if index >= len(histogram.counts):
+                histogram.counts.extend(bytes(8*(index + 1 - len(histogram.counts))))
+            histogram.counts[index] = count
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
 
 class SimpleTimer(object):
-    def __init__(self, message=''):
+    def __init__(self, message='', histogram=None):
         """Class for simple timing of calls.
         message -- str, the message accompanying the elapsed time.
+        histogram -- LatencyHistogram, receives the nanoseconds of each lap.
 
         """
-        self.time_start = time.clock()
+        self.time_start = time.perf_counter()
         self.message = message
+        self.histogram = histogram
+        self._lap_start = time.perf_counter_ns()
+
+    def lap(self):
+        """Return the seconds since the previous lap, or construction, and record them in the histogram."""
+        now = time.perf_counter_ns()
+        elapsed, self._lap_start = now - self._lap_start, now
+        if self.histogram is not None:
+            self.histogram.record(elapsed)
+        return elapsed/1e9
 
     def __str__(self):
         return self.represent()
@@ -175,7 +939,7 @@ class SimpleTimer(object):
         return self.represent()
 
     def time(self):
-        return time.clock()-self.time_start
+        return time.perf_counter()-self.time_start
 
     def represent(self, message = ''):
         checkpoint = self.time()
@@ -191,6 +955,208 @@ class SimpleTimer(object):
         print(self.represent(message=message))
 
 
+class SectionStats(LatencyHistogram):
+    """Aggregated timings of one section path, in nanoseconds. Keeps count, total, min, max and mean, and the
+    histogram of LatencyHistogram for percentiles."""
+
+    def add(self, elapsed):
+        self.record(elapsed)
+
+
+class _Section(object):
+    """Context manager timing one section of a Timers registry. Stateless apart from its name, so one instance is
+    reused for every entry, nested or from any thread."""
+    __slots__ = ('timers', 'name')
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        local = self.timers._thread_state()
+        stack = local.stack
+        path = stack[-1][0] + (self.name,) if stack else (self.name,)
+        stack.append((path, time.perf_counter_ns()))
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        local = self.timers._local
+        path, start = local.stack.pop()
+        stats = local.stats.get(path)
+        if stats is None:
+            stats = local.stats[path] = SectionStats(self.timers.precision)
+        stats.add(end - start)
+        if self.timers.tracer is not None:
+            self.timers.tracer.complete(self.name, start, end - start, path)
+
+
+class _NullSection(object):
+    """Section used while profiling is off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SECTION = _NullSection()
+
+
+class Timers(object):
+    def __init__(self, enabled=True, precision=7, tracer=None):
+        """Registry of hierarchical timing sections.
+
+        with timers.section('load'):
+            with timers.section('parse'):
+                ...
+
+        @timers.timed('save')
+        def save(): ...
+
+        Sections entered inside other sections are nested under them, per thread, and the count, total, min, max and
+        mean time is kept per path of section names. Times are taken with time.perf_counter_ns. While enabled is False,
+        section() returns a shared no-op context manager and timed functions are called directly.
+
+        Each path also keeps a LatencyHistogram of its times, for percentiles over any number of samples in fixed
+        memory. Other measurement streams are added with record(name, nanoseconds). The stats of all threads are
+        merged by stats(), and export()/merge() move them between processes.
+
+        enabled -- bool, if the sections are timed.
+        precision -- int, precision of the histograms, see LatencyHistogram.
+        tracer -- tracer.Tracer, records every timed section as a complete event.
+        """
+        self.enabled = enabled
+        self.precision = precision
+        self.tracer = tracer
+        self._sections = {}
+        self._local = threading.local()
+        self._thread_stats = []
+        self._lock = threading.Lock()
+
+    def _thread_state(self):
+        """Return the section stack and stats of the current thread. Each thread records to its own stats, so
+        recording needs no lock."""
+        local = self._local
+        try:
+            local.stack
+        except AttributeError:
+            local.stack = []
+            local.stats = {}
+            with self._lock:
+                self._thread_stats.append(local.stats)
+        return local
+
+    def section(self, name):
+        """Return a context manager timing the section name."""
+        if not self.enabled:
+            return _NULL_SECTION
+        try:
+            return self._sections[name]
+        except KeyError:
+            section = self._sections[name] = _Section(self, name)
+            return section
+
+    def timed(self, name=None):
+        """Decorator timing each call of the function as section name, default the function name."""
+        def decorator(func):
+            section_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.section(section_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, elapsed):
+        """Record elapsed nanoseconds for name, nested under the current section of the thread, if any."""
+        local = self._thread_state()
+        path = local.stack[-1][0] + (name,) if local.stack else (name,)
+        stats = local.stats.get(path)
+        if stats is None:
+            stats = local.stats[path] = SectionStats(self.precision)
+        stats.add(elapsed)
+
+    def stats(self):
+        """Return a dict of section path tuples to the SectionStats of all threads."""
+        merged = {}
+        with self._lock:
+            thread_stats = list(self._thread_stats)
+        for stats in thread_stats:
+            for path, section_stats in list(stats.items()):
+                if path not in merged:
+                    merged[path] = SectionStats(self.precision)
+                merged[path].merge(section_stats)
+        return merged
+
+    def percentiles(self, path, percents=(50, 95, 99, 99.9)):
+        """Return a dict of percent to nanoseconds for a section path tuple or name."""
+        if isinstance(path, str):
+            path = (path,)
+        stats = self.stats().get(path)
+        if stats is None:
+            return dict((percent, 0.0) for percent in percents)
+        return stats.percentiles(percents)
+
+    def export(self):
+        """Return the merged stats as a list of plain values, for pickle or json, e.g. to send from a worker
+        process."""
+        return [[list(path), stats.to_dict()] for path, stats in self.stats().items()]
+
+    def merge(self, exported):
+        """Add stats from export() of another registry, e.g. from a worker process."""
+        local = self._thread_state()
+        for path, data in exported:
+            path = tuple(path)
+            histogram = LatencyHistogram.from_dict(data)
+            if path not in local.stats:
+                local.stats[path] = SectionStats(histogram.precision)
+            local.stats[path].merge(histogram)
+
+    def reset(self):
+        """Forget all timings."""
+        with self._lock:
+            for stats in self._thread_stats:
+                stats.clear()
+
+    def report(self, file=None, sort='total'):
+        """Print the sections as a tree, children under their parents, sorted by sort ('total', 'count', 'mean', 'max'
+        or 'min') within each parent. Times in milliseconds."""
+        print(self.string(sort), file=file)
+
+    def string(self, sort='total'):
+        """Return the report, see report."""
+        stats = self.stats()
+        children = {}
+        for path in stats:
+            children.setdefault(path[:-1], []).append(path)
+
+        lines = ['%-40s %10s %12s %10s %10s %10s %10s %10s' % (
+            'section', 'count', 'total [ms]', 'mean', 'min', 'max', 'p50', 'p99')]
+
+        def add(parent, depth):
+            paths = sorted(children.get(parent, []), key=lambda path: getattr(stats[path], sort), reverse=True)
+            for path in paths:
+                section = stats[path]
+                lines.append('%-40s %10d %12.3f %10.3f %10.3f %10.3f %10.3f %10.3f' % (
+                    '  '*depth + path[-1], section.count, section.total/1e6, section.mean/1e6,
+                    (section.min or 0)/1e6, section.max/1e6, section.quantile(0.5)/1e6, section.quantile(0.99)/1e6))
+                add(path, depth + 1)
+
+        add((), 0)
+        return '\n'.join(lines)
+
+
+timers = Timers()  # Default registry.
+section = timers.section
+timed = timers.timed
+
+
 if __name__ == '__main__':
     from tests import test_simpletimer
     test_simpletimer.run()
\ No newline at end of file
@@ -13,6 +13,8 @@ from __future__ import unicode_literals
 import unittest
 import sys
 import os
+import shutil
+import time
 
 sys.path = [os.path.split(os.path.split(os.path.realpath(__file__))[0])[0] + os.path.sep] + sys.path
 
@@ -49,6 +51,748 @@ class TestLoggerModule(unittest.TestCase):
         log.printLogToFile(write_path, write_name + '.txt', completeName=True, errorTag=True)
         os.remove(log.log_file_path)
 
+    def test_streaming_log(self):
+        import logger
+        import time
+
+        write_path = os.path.dirname(__file__)
+        write_name = 'test_stream_log.txt'
+
+        log = logger.Log(streamPath=write_path, streamName=write_name, streamTitle='Stream', completeName=True,
+                         flushCount=5)
+        try:
+            for i in range(10):
+                log.addMessage('Message nr %d' % i)
+                log.addWarning('Warning nr %d' % i)
+            log.addError('Error nr 0')
+
+            # Nothing is kept in memory, and the error flushed everything to disk:
+            self.assertEqual(len(log.m), 0)
+            with open(log.log_file_path) as f:
+                text = f.read()
+            self.assertTrue(text.startswith('--------------\n--- Stream ---'))
+            self.assertTrue('Message nr 9' in text)
+            self.assertTrue(text.endswith('Error: Error nr 0'))
+        finally:
+            log.close()
+
+        with open(log.log_file_path) as f:
+            text = f.read()
+        os.remove(log.log_file_path)
+
+        self.assertTrue('Number of warning messages logged: 10' in text)
+        self.assertTrue('Number of error messages logged: 1' in text)
+        self.assertTrue(text.endswith('End of file.'))
+
+        # A quiet log is flushed by the timer after flushInterval milliseconds:
+        log = logger.Log(streamPath=write_path, streamName=write_name, completeName=True, flushInterval=20)
+        try:
+            log.addMessage('Quiet message')
+            time.sleep(0.2)
+            with open(log.log_file_path) as f:
+                self.assertTrue('Quiet message' in f.read())
+        finally:
+            log.close()
+            os.remove(log.log_file_path)
+
+    def test_message_store(self):
+        import logger
+
+        log = logger.Log()
+        log.addMessage(['First', 'Second'])
+        log.addError('Error', timestamp=False)
+        log.addWarning('Warning', newLine=False)
+
+        self.assertEqual(len(log.m), 3)
+        self.assertTrue(isinstance(log.m[-1], logger.Message))
+        self.assertTrue(log.m[1].error and not log.m[1].timestamp)
+        self.assertTrue(log.m[2].warning and not log.m[2].newline)
+        self.assertEqual([m.text for m in log.m[:2]], [['First', 'Second'], 'Error'])
+
+        # Compiling from the store gives the same text as the Message views:
+        text = log._logHeader_('Log') + ''.join(m.getMessage() for m in log.m) + log._logFooter_()
+        self.assertEqual(log.returnLogAsString('Log'), text)
+
+        # Appending a Message object keeps its time and flags:
+        message = logger.Message('Appended', warning=True)
+        log.m.append(message)
+        self.assertEqual(log.m[-1].getMessage(), message.getMessage())
+
+        # A record older than the last one keeps its epoch and is stored at
+        # its place in time order:
+        store = logger.MessageStore()
+        for epoch, flags in [(1, 0), (2, logger.ERROR), (4, logger.WARNING), (5, logger.ERROR)]:
+            store.add(epoch, 'At %d' % epoch, flags)
+        store.add(3, 'Late', logger.ERROR)
+        store.addMany(0, ['Later', 'Latest'], bytes([logger.WARNING, 0]))
+        self.assertEqual(list(store.times), [0, 0, 1, 2, 3, 4, 5])
+        self.assertEqual(store.texts, ['Later', 'Latest', 'At 1', 'At 2', 'Late', 'At 4', 'At 5'])
+        self.assertEqual([store.texts[i] for i in store.indices('error')], ['At 2', 'Late', 'At 5'])
+        self.assertEqual([store.texts[i] for i in store.indices('warning')], ['Later', 'At 4'])
+        self.assertEqual(store.count('error', since=2.5), 2)
+
+    def test_threaded_log(self):
+        import logger
+        import threading
+
+        log = logger.Log()
+
+        def write(name):
+            for i in range(2000):
+                log.addMessage('%s message %d' % (name, i))
+                log.addWarning('%s warning %d' % (name, i))
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=write, args=('Thread %d' % i,)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        store = log.m
+        self.assertEqual(len(store), 8000)
+        self.assertEqual(log.warningCount, 4000)
+        for text, flags in zip(store.texts, store.flags):
+            self.assertEqual('warning' in text, bool(flags & logger.WARNING))
+        self.assertEqual(len(store.warningIndex), 4000)
+        self.assertTrue(all('warning' in store.texts[i] for i in store.warningIndex))
+        self.assertEqual(list(store.times), sorted(store.times))
+        self.assertEqual(log.count('warning'), 4000)
+
+    def test_timestamp_cache(self):
+        import logger
+        import datetime
+        import time
+
+        cache = logger.TimestampCache(maxSize=10)
+        start = time.time()
+        for i in range(1000):
+            epoch = start + i * 0.37
+            self.assertEqual(cache.stamp(epoch),
+                             datetime.datetime.fromtimestamp(epoch).strftime('%Y.%m.%d %H:%M:%S'))
+        self.assertTrue(len(cache._stamps_) <= 10)
+
+        # Shared by threads missing the cache at the same time:
+        import threading
+        cache = logger.TimestampCache(maxSize=64)
+        failures = []
+
+        def stampMany(offset):
+            try:
+                for i in range(20000):
+                    cache.stamp(start + offset + i * 0.7)
+            except Exception as e:
+                failures.append(e)
+
+        threads = [threading.Thread(target=stampMany, args=(i * 1000,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        self.assertTrue(len(cache._stamps_) <= 64)
+
+        log = logger.Log(monotonicClock=True)
+        log.addMessage('Monotonic')
+        message = log.m[0]
+        self.assertTrue(abs(message.epoch - time.time()) < 1)
+        self.assertEqual(message.getMessage(), '\n%s-Monotonic' % message.time.strftime('%Y.%m.%d %H:%M:%S'))
+
+    def test_asynchronous_log(self):
+        import logger
+
+        write_path = os.path.dirname(__file__)
+        write_name = 'test_async_log.txt'
+
+        with logger.Log(asynchronous=True, streamPath=write_path, streamName=write_name, completeName=True) as log:
+            for i in range(10000):
+                log.addMessage('Message nr %d' % i)
+            log.addError('Error nr 0')
+            log.flush()
+            self.assertEqual(log.writer.queue, logger.deque())
+            self.assertEqual(log.droppedCount, 0)
+
+        with open(log.log_file_path) as f:
+            text = f.read()
+        os.remove(log.log_file_path)
+
+        self.assertEqual(text.count('Message nr'), 10000)
+        self.assertTrue(text.index('Message nr 9999') < text.index('Error: Error nr 0'))
+        self.assertTrue('Number of error messages logged: 1' in text)
+
+        # Messages are kept in memory when not streaming:
+        log = logger.Log(asynchronous=True, queueSize=10, overflow='drop')
+        for i in range(1000):
+            log.addWarning('Warning nr %d' % i)
+        log.close()
+        self.assertEqual(log.warningCount, 1000)
+        self.assertEqual(len(log.m) + log.droppedCount, 1000)
+        self.assertEqual(log.returnLogAsString().count('Warning: '), len(log.m))
+
+    def test_asynchronous_log_failure(self):
+        import logger
+
+        class BrokenSink(object):
+            def open(self, log, title):
+                pass
+
+            def write(self, message):
+                if 'broken' in message.text:
+                    raise OSError('Disk full')
+
+            def flush(self):
+                raise OSError('Disk full')
+
+            def close(self, log):
+                pass
+
+        # A failing sink is counted, and the writer goes on with the next record:
+        log = logger.Log(asynchronous=True, queueSize=10)
+        log.addSink(BrokenSink())
+        for i in range(100):
+            log.addMessage('Message nr %d%s' % (i, ' broken' if i % 10 == 0 else ''))
+        log.flush()
+        self.assertTrue(log.writer.thread.is_alive())
+        self.assertEqual(log.writer.failures, 10 + 1)
+        self.assertTrue(isinstance(log.writer.lastError, OSError))
+        self.assertEqual(len(log.m), 100)
+
+        # Once the writer is gone, records are written by the caller instead of
+        # waiting for it:
+        log.writer.queue.append(None)
+        log.writer._wake_.set()
+        log.writer.thread.join()
+        for i in range(100):
+            log.addMessage('Late nr %d' % i)
+        log.flush()
+        log.close()
+        self.assertEqual(len(log.m), 200)
+        self.assertEqual(log.m[-1].text, 'Late nr 99')
+
+    def test_log_collector(self):
+        import logger
+        from concurrent.futures import ProcessPoolExecutor
+
+        class CapturingSink(object):
+            def __init__(self):
+                self.epochs = []
+
+            def open(self, log, title):
+                pass
+
+            def write(self, message):
+                self.epochs.append(message.epoch)
+
+            def flush(self):
+                pass
+
+            def close(self, log):
+                pass
+
+        # Records are merged by their worker epochs, which are kept:
+        log = logger.Log()
+        sink = CapturingSink()
+        log.addSink(sink)
+        collector = logger.LogCollector(log, workers=2, maxDelay=10)
+        t = time.time()
+        collector.queue.put(('batch', 1, [(t + 0, 0, 'a'), (t + 2, logger.ERROR, 'b'), (t + 4, 0, 'c')]))
+        collector.queue.put(('batch', 2, [(t + 1, 0, 'd'), (t + 3, logger.WARNING, 'e')]))
+        collector.queue.put(('close', 2, None))
+        collector.queue.put(('batch', 2, [(t - 1, 0, 'late')]))
+        collector.close()
+        self.assertEqual(sink.epochs, [t + 0, t + 1, t + 2, t + 3, t + 4, t - 1])
+        self.assertEqual(list(log.m.times), [t - 1, t + 0, t + 1, t + 2, t + 3, t + 4])
+        self.assertEqual([m.text for m in log.errors()], ['[1] b'])
+        self.assertEqual(log.m[0].text, '[2] late')
+
+        log = logger.Log()
+        sink = CapturingSink()
+        log.addSink(sink)
+        collector = logger.LogCollector(log, workers=8, maxDelay=10)
+        with ProcessPoolExecutor(8, initializer=logger.initWorker, initargs=(collector.queue,)) as pool:
+            self.assertEqual(sum(pool.map(_log_in_worker, range(32))), 32 * 1000)
+        collector.close()
+
+        self.assertEqual(len(log.m), 32 * 1000)
+        self.assertEqual(log.errorCount, 32 * 10)
+        self.assertEqual(log.warningCount, 32 * 10)
+        self.assertEqual(collector.errorCount, 32 * 10)
+        self.assertTrue(1 <= len(collector.workerCounts) <= 8)
+
+        epochs = sink.epochs
+        self.assertTrue(all(epochs[i] <= epochs[i + 1] for i in range(len(epochs) - 1)))
+        self.assertEqual(list(log.m.times), epochs)
+        self.assertTrue(log.m[0].text.startswith('['))
+
+        # An asynchronous log is written by its writer only, while the parent
+        # logs at the same time:
+        log = logger.Log(asynchronous=True)
+        collector = logger.LogCollector(log, workers=4)
+        with ProcessPoolExecutor(4, initializer=logger.initWorker, initargs=(collector.queue,)) as pool:
+            results = pool.map(_log_in_worker, range(8))
+            for i in range(5000):
+                log.addWarning('Parent %d' % i)
+            self.assertEqual(sum(results), 8 * 1000)
+        collector.close()
+        log.close()
+
+        self.assertEqual(len(log.m), 8 * 1000 + 5000)
+        self.assertEqual(log.warningCount, 8 * 10 + 5000)
+        self.assertEqual(len(log.m.warningIndex), 8 * 10 + 5000)
+        self.assertEqual(list(log.m.times), sorted(log.m.times))
+
+    def test_rotating_log(self):
+        import logger
+        import gzip
+        import tempfile
+
+        write_path = tempfile.mkdtemp()
+        log = logger.Log(streamPath=write_path, streamName='rotating', maxBytes=2000, maxBackups=3, compress='gzip')
+        for i in range(500):
+            log.addMessage('Message nr %d' % i)
+        log.close()
+
+        sink_path = log.log_file_path
+        backups = sorted(f for f in os.listdir(write_path) if f.endswith('.gz'))
+        self.assertEqual(len(backups), 3)
+        self.assertTrue(os.path.basename(sink_path) + '.1.gz' not in backups)
+        with gzip.open(os.path.join(write_path, backups[-1]), 'rt') as f:
+            text = f.read()
+        self.assertTrue(text.startswith('-------'))
+        self.assertTrue(text.endswith('End of file.'))
+        self.assertTrue(os.path.getsize(sink_path) <= 2000)
+        with open(sink_path) as f:
+            self.assertTrue('Message nr 499' in f.read())
+
+        # Increments fill in after existing names, without listing the folder:
+        name = log._addTimeStampToFileName_('increment')
+        for i in range(5):
+            log.printLogToFile(write_path, 'increment')
+        self.assertEqual(os.path.basename(log.log_file_path), name.replace('.txt', ' (5).txt'))
+        logger._nameIncrements_.clear()
+        log.printLogToFile(write_path, 'increment')
+        self.assertEqual(os.path.basename(log.log_file_path), name.replace('.txt', ' (6).txt'))
+
+        shutil.rmtree(write_path)
+
+    def test_structured_log(self):
+        import logger
+        import tempfile
+
+        write_path = tempfile.mkdtemp()
+        log = logger.Log()
+        for i in range(5000):
+            if i % 500 == 7:
+                log.addError('Error nr %d' % i)
+            elif i % 50 == 3:
+                log.addWarning('Warning nr %d' % i, timestamp=False, newLine=False)
+            else:
+                log.addMessage(['List nr %d' % i, 'Second line'] if i % 1000 == 0 else 'Message nr %d' % i)
+        log.printLogToFile(write_path, 'structured', format='jsonl')
+        self.assertTrue(log.log_file_path.endswith('.jsonl'))
+        self.assertTrue(os.path.exists(log.log_file_path + '.idx'))
+
+        with logger.LogReader(log.log_file_path) as reader:
+            self.assertEqual(reader.count(), 5000)
+            self.assertEqual(reader.count('error'), 10)
+            self.assertEqual(reader.count('warning'), 100)
+            self.assertEqual([m.text for m in reader.last(2, 'warning')], ['Warning nr 4903', 'Warning nr 4953'])
+            since, until = log.m[2000].time, log.m[3999].epoch
+            self.assertEqual([m.text for m in reader.errors(since, until)],
+                             ['Error nr %d' % i for i in (2007, 2507, 3007, 3507)])
+            self.assertEqual(reader.returnLogAsString('Run log'), log.returnLogAsString('Run log'))
+
+        # Without the side index, the reader indexes the file itself:
+        os.remove(log.log_file_path + '.idx')
+        with logger.LogReader(log.log_file_path) as reader:
+            self.assertEqual(reader.count('error'), 10)
+            self.assertEqual(len(reader.last(1000)), 1000)
+
+        shutil.rmtree(write_path)
+
+    def test_query_log(self):
+        import logger
+        import datetime
+
+        log = logger.Log()
+        for i in range(1000):
+            if i % 100 == 7:
+                log.addError('Error nr %d' % i)
+            elif i % 10 == 3:
+                log.addWarning('Warning nr %d' % i)
+            else:
+                log.addMessage('Message nr %d' % i)
+
+        self.assertEqual(len(log.errors()), 10)
+        self.assertEqual(len(log.m.warningIndex), 100)
+        since, until = log.m[500].time, log.m[799].epoch
+        self.assertEqual([m.text for m in log.errors(since, until)], ['Error nr 507', 'Error nr 607', 'Error nr 707'])
+        self.assertEqual([m.text for m in log.last(2, 'warning')], ['Warning nr 983', 'Warning nr 993'])
+        self.assertEqual([m.text for m in log.last(2, 'message')], ['Message nr 998', 'Message nr 999'])
+        self.assertEqual(len(log.query('message', since, until)), 300 - 3 - 30)
+        self.assertEqual(log.count('error'), 10)
+        self.assertEqual(log.count('message', datetime.timedelta(hours=1)), 1000 - 10 - 100)
+        self.assertEqual(log.count(window=-60), 0)
+
+        # The time of a message is a bound that finds the message:
+        for message in log.errors():
+            self.assertEqual([m.text for m in log.errors(message.time, message.time)], [message.text])
+
+        # The log can be queried from another thread while it is written:
+        import threading
+
+        log = logger.Log()
+        done = threading.Event()
+
+        def write():
+            for i in range(20000):
+                log.addError('Error nr %d' % i)
+            done.set()
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            thread = threading.Thread(target=write)
+            thread.start()
+            while not done.is_set():
+                self.assertTrue(all(message.error for message in log.last(1, 'error') + log.last(1)))
+                self.assertTrue(log.count('error') <= log.count())
+            thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(log.count('error'), 20000)
+
+    def test_bounded_log(self):
+        import logger
+
+        write_path = os.path.dirname(__file__)
+        write_name = 'test_bounded_log.txt'
+
+        log = logger.Log(streamPath=write_path, streamName=write_name, completeName=True, maxMessages=10,
+                         maxLevelMessages=5, dedupWindow=60)
+        try:
+            log.addError('Disk full')
+            for i in range(100):
+                log.addMessage('Message nr %d' % i)
+                log.addError('Disk full')
+                log.addWarning('Retrying')
+            log.addError('Another error')
+
+            # Errors stay exact, and the storm is kept as two entries:
+            self.assertEqual(log.errorCount, 102)
+            self.assertEqual(log.warningCount, 100)
+            self.assertEqual(len(log.m), 13)
+            self.assertEqual(log.m.collapsed, 199)
+            self.assertEqual(log.m.dropped, 90)
+            self.assertEqual(log.count('error'), 102)
+            self.assertEqual([m.text for m in log.last(2, 'message')], ['Message nr 98', 'Message nr 99'])
+            errors = log.errors()
+            self.assertTrue(errors[0].text.startswith('Disk full [repeated 101 times, last at '))
+            self.assertEqual(errors[-1].text, 'Another error')
+
+            text = log.returnLogAsString('Bounded')
+            self.assertTrue('Message nr 89' not in text and 'Message nr 90' in text)
+            self.assertTrue('Number of messages suppressed: 289 (199 repeats collapsed, 90 dropped from memory)'
+                            in text)
+        finally:
+            log.close()
+
+        with open(log.log_file_path) as f:
+            lines = f.read().split('\n')
+        os.remove(log.log_file_path)
+
+        # The stream has every message once, and the repeats within the window
+        # as one count at close:
+        self.assertEqual(sum(line.endswith('Message nr 50') for line in lines), 1)
+        self.assertEqual(sum('Disk full' in line for line in lines), 2)
+        self.assertTrue(lines[-9].endswith('Error: Another error'))
+        self.assertTrue(lines[-8].endswith('Error: Disk full [repeated 100 more times]'))
+        self.assertTrue(lines[-7].endswith('Warning: Retrying [repeated 99 more times]'))
+
+        # Without a window, only consecutive messages are collapsed:
+        log = logger.Log(maxMessages=100)
+        for text in ['A', 'A', 'B', 'A', 'A', 'A']:
+            log.addMessage(text)
+        self.assertEqual([m.text.split(' ')[0] for m in log.m], ['A', 'B', 'A'])
+        self.assertEqual(log.count(), 6)
+
+    def test_add_many(self):
+        import logger
+
+        log = logger.Log()
+        log.add_many(['Message nr %d' % i for i in range(5)])
+        log.add_many(('Error nr %d' % i for i in range(3)), level='error', timestamp=False)
+        log.add_many(['a', 'b', 'c', 'd'], level=['message', 'warning', 'error', 'warning'])
+        log.add_many(['Checked', 'Failed'], level=[False, True])
+
+        self.assertEqual(len(log.m), 14)
+        self.assertEqual(log.errorCount, 5)
+        self.assertEqual(log.warningCount, 2)
+        self.assertEqual(log.count('error'), 5)
+        self.assertEqual([m.text for m in log.warnings()], ['b', 'd'])
+        self.assertEqual([m.text for m in log.last(2, 'error')], ['c', 'Failed'])
+        self.assertEqual(len(set(log.m.times[:5])), 1)
+        self.assertFalse(log.m[5].timestamp)
+
+        # The same text as when the messages are added one by one:
+        single = logger.Log()
+        single.init = log.init
+        for message in log.m:
+            single.m.append(message)
+        single.errorCount, single.warningCount = log.errorCount, log.warningCount
+        self.assertEqual(single.returnLogAsString(), log.returnLogAsString())
+
+        # Bounded logs collapse repeats within the batch:
+        log = logger.Log(maxMessages=10)
+        log.add_many(['Same'] * 100, level='error')
+        self.assertEqual(log.errorCount, 100)
+        self.assertEqual(len(log.m), 1)
+
+    def test_email_sink(self):
+        import logger
+        import email
+        import tempfile
+
+        server = _SmtpStandIn()
+        attachment = os.path.join(tempfile.mkdtemp(), 'attachment.txt')
+        with open(attachment, 'w') as f:
+            for i in range(20000):
+                f.write('Attached line nr %d\n' % i)
+
+        log = logger.Log()
+        sink = logger.EmailSink('localhost', 'log@example.com', ['ops@example.com'], port=server.port,
+                                digestCount=1000, minSendInterval=0, attachments=[attachment])
+        log.addSink(sink, 'Mailed log')
+        for i in range(2500):
+            log.addMessage('Message nr %d' % i)
+        log.addError('Final error')
+        log.close()
+        server.close()
+
+        # The digests are sent by the sink thread, which may have been woken
+        # with more than digestCount lines waiting:
+        self.assertTrue(2 <= sink.sent <= 3)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.mails), sink.sent)
+        count = 0
+        for mail in server.mails:
+            mail = email.message_from_bytes(mail)
+            if mail.is_multipart():
+                mail = mail.get_payload()[0]
+            count += mail.get_payload(decode=True).decode('utf-8').count('Message nr')
+        self.assertEqual(count, 2500)
+
+        mail = email.message_from_bytes(server.mails[-1])
+        self.assertEqual(mail['Subject'], 'Log: Mailed log')
+        body, attached = mail.get_payload()
+        text = body.get_payload(decode=True).decode('utf-8')
+        self.assertTrue('Message nr 2499' in text and 'Error: Final error' in text)
+        self.assertTrue(text.endswith('End of file.'))
+        with open(attachment, 'rb') as f:
+            self.assertEqual(attached.get_payload(decode=True), f.read())
+        shutil.rmtree(os.path.dirname(attachment))
+
+        # Digests are held back by the send interval until close:
+        server = _SmtpStandIn()
+        log = logger.Log()
+        sink = logger.EmailSink('localhost', 'log@example.com', 'ops@example.com', port=server.port,
+                                digestCount=10, minSendInterval=3600)
+        log.addSink(sink)
+        for i in range(100):
+            log.addError('Error nr %d' % i)
+        self.assertTrue(_wait_for(lambda: sink.sent))
+        time.sleep(0.1)
+        self.assertEqual(sink.sent, 1)
+        log.close()
+        server.close()
+        self.assertEqual(len(server.mails), 2)
+
+        # A digest is sent by the timer when no more messages come:
+        server = _SmtpStandIn()
+        log = logger.Log()
+        sink = logger.EmailSink('localhost', 'log@example.com', 'ops@example.com', port=server.port,
+                                digestInterval=0.05, minSendInterval=0)
+        log.addSink(sink)
+        log.addError('Lonely error')
+        self.assertTrue(_wait_for(lambda: server.mails))
+        self.assertEqual(len(server.mails), 1)
+        log.close()
+        server.close()
+
+    def test_email_sink_failure(self):
+        import logger
+        import email
+        import socket
+
+        probe = socket.socket()
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        # With the relay down, logging goes on and the lines are kept:
+        write_path = os.path.dirname(__file__)
+        log = logger.Log(streamPath=write_path, streamName='test_email_failure.txt', completeName=True)
+        sink = logger.EmailSink('localhost', 'log@example.com', 'ops@example.com', port=port, digestCount=1,
+                                minSendInterval=0, retryInterval=0.05, timeout=1)
+        log.addSink(sink)
+        log.addMessage('First')
+        log.addError('Second')
+        self.assertTrue(_wait_for(lambda: sink.failures >= 1 and len(sink.unsent) == 2))
+        self.assertEqual(sink.sent, 0)
+        self.assertTrue(isinstance(sink.lastError, OSError))
+
+        # Sent by the timer once the relay is back:
+        server = _SmtpStandIn(port)
+        try:
+            self.assertTrue(_wait_for(lambda: sink.sent))
+            self.assertEqual(sink.sent, 1)
+            self.assertEqual(sink.unsent, [])
+            mail = email.message_from_bytes(server.mails[0])
+            if mail.is_multipart():
+                mail = mail.get_payload()[0]
+            text = mail.get_payload(decode=True).decode('utf-8')
+            self.assertTrue('First' in text and 'Error: Second' in text)
+        finally:
+            server.close()
+
+        # The relay is down again on close, and the file still gets its footer:
+        log.close()
+        with open(log.log_file_path) as f:
+            self.assertTrue(f.read().endswith('End of file.'))
+        os.remove(log.log_file_path)
+
+    def test_email_sink_hanging_relay(self):
+        import logger
+        import socket
+        import threading
+
+        # A relay that accepts connections but never answers:
+        relay = socket.socket()
+        relay.bind(('localhost', 0))
+        relay.listen(5)
+        try:
+            log = logger.Log()
+            sink = logger.EmailSink('localhost', 'log@example.com', 'ops@example.com', port=relay.getsockname()[1],
+                                    digestCount=1, minSendInterval=0, timeout=0.5)
+            log.addSink(sink)
+
+            # Logging does not wait for the relay, in this thread or another:
+            start = time.time()
+            log.addError('Due at once')
+            thread = threading.Thread(target=log.addMessage, args=('From another thread',))
+            thread.start()
+            thread.join()
+            self.assertTrue(time.time() - start < 0.25)
+
+            # The sink thread times out, and keeps the lines for the last digest:
+            self.assertTrue(_wait_for(lambda: sink.failures >= 1))
+            log.close()
+            self.assertTrue(isinstance(sink.lastError, OSError))
+            self.assertTrue(sink.unsent[-1].endswith('-From another thread'))
+            self.assertEqual(sink.sent, 0)
+        finally:
+            relay.close()
+
+    def test_close_all_sinks(self):
+        import logger
+
+        class BrokenSink(object):
+            def open(self, log, title):
+                pass
+
+            def write(self, message):
+                pass
+
+            def flush(self):
+                pass
+
+            def close(self, log):
+                raise OSError('Broken')
+
+        write_path = os.path.dirname(__file__)
+        log = logger.Log()
+        log.addSink(BrokenSink())
+        sink = log.openLogFile(write_path, 'test_close_all_sinks.txt', completeName=True)
+        log.addMessage('Message')
+        self.assertRaises(OSError, log.close)
+        with open(sink.filePath) as f:
+            self.assertTrue(f.read().endswith('End of file.'))
+        os.remove(sink.filePath)
+
+
+class _SmtpStandIn(object):
+    # Minimal local SMTP server, storing received mails.
+
+    def __init__(self, port=0):
+        import socketserver
+        import threading
+
+        stand_in = self
+        self.mails = []
+        self.connections = 0
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stand_in.connections += 1
+                self.wfile.write(b'220 localhost\r\n')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line[:4].upper()
+                    if command == b'DATA':
+                        self.wfile.write(b'354 go ahead\r\n')
+                        data = []
+                        for line in iter(self.rfile.readline, b'.\r\n'):
+                            data.append(line[1:] if line.startswith(b'..') else line)
+                        stand_in.mails.append(b''.join(data))
+                        self.wfile.write(b'250 ok\r\n')
+                    elif command == b'QUIT':
+                        self.wfile.write(b'221 bye\r\n')
+                        return
+                    else:
+                        self.wfile.write(b'250 ok\r\n')
+
+        self.server = Server(('localhost', port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _wait_for(condition, timeout=5.0):
+    # Poll condition until it is true or timeout seconds have passed.
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _log_in_worker(task):
+    import logger
+
+    log = logger.workerLog()
+    for i in range(1000):
+        if i % 100 == 1:
+            log.addError('Task %d error %d' % (task, i))
+        elif i % 100 == 2:
+            log.addWarning('Task %d warning %d' % (task, i))
+        else:
+            log.addMessage('Task %d message %d' % (task, i))
+    return 1000
+
 
 def run():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestLoggerModule)
@@ -1,4 +1,4 @@
-# -*- coding: utf-8 -*-
+﻿# -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 #-------------------------------------------------------------------------------
 # Name:        test_units
@@ -42,6 +42,337 @@ class TestSimpletimerModule(unittest.TestCase):
 
         self.assertTrue(re.findall('This is a regular test: %3d%%: ETA in' % 20, timer.string(count=20)))
 
+    def test_ProgressTimer_estimators(self):
+        import simpletimer
+
+        for estimator in simpletimer.ESTIMATORS:
+            timer = simpletimer.ProgressTimer(1000, 'Estimator', sample_size=10, estimator=estimator)
+            for i in range(20):
+                time.sleep(0.001)
+                percentage, hours, minutes, seconds = timer.calculate_sample(None)
+            self.assertEqual(round(percentage), 2)
+            # Roughly a millisecond per iteration leaves about a second:
+            self.assertTrue(0 <= seconds <= 10)
+            self.assertEqual(hours, 0)
+            self.assertTrue(re.findall('Estimator:   2%: ETA in', timer.string()))
+
+            # An explicit count is used as given:
+            self.assertTrue(re.findall('Estimator:  50%: ETA in', timer.string(count=500)))
+            self.assertEqual(timer.count, 500)
+
+        timer = simpletimer.ProgressTimer(1000, sample_size=10)
+        for i in range(25):
+            timer.calculate_sample(None)
+        self.assertEqual(len(timer.time_sample), 10)
+        self.assertEqual(timer.time_sample, sorted(timer.time_sample))
+
+    def test_ProgressTimer_wrap(self):
+        import simpletimer
+        import io
+
+        output = io.StringIO()
+        timer = simpletimer.ProgressTimer(100, 'Wrapped')
+        items = []
+        for item in timer.wrap(range(100), min_interval=0.01, file=output):
+            time.sleep(0.001)
+            items.append(item)
+
+        self.assertEqual(items, list(range(100)))
+        self.assertEqual(timer.count, 100)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(1 < len(lines) < 30)
+        self.assertTrue(lines[-1].startswith('Wrapped: 100%: ETA in'))
+
+        # The sampled estimators end at the item count too:
+        output = io.StringIO()
+        timer = simpletimer.ProgressTimer(100, 'Wrapped', estimator='ewma')
+        self.assertEqual(len(list(timer.wrap(range(100), min_interval=0, file=output))), 100)
+        self.assertEqual(timer.count, 100)
+        self.assertTrue(output.getvalue().splitlines()[-1].startswith('Wrapped: 100%: ETA in'))
+
+        output = io.StringIO()
+        self.assertEqual(sum(simpletimer.track(list(range(1000)), 'Tracked', min_interval=3600, file=output)), 499500)
+        self.assertEqual(output.getvalue().count('\n'), 1)
+
+    def test_SharedProgressTimer(self):
+        import simpletimer
+        import io
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+        output = io.StringIO()
+        timer = simpletimer.SharedProgressTimer(16*100000 + 4*250000, 'Shared')
+        timer.start_render(interval=0.01, file=output)
+
+        def count_in_thread(task):
+            for i in range(100000):
+                timer.update()
+
+        with ThreadPoolExecutor(16) as pool:
+            list(pool.map(count_in_thread, range(16)))
+        timer.flush()
+        self.assertEqual(timer.shared_value, 16*100000)
+
+        with ProcessPoolExecutor(4, initializer=simpletimer.init_progress_worker,
+                                 initargs=(timer.shared_count,)) as pool:
+            self.assertEqual(sum(pool.map(_count_in_process, range(4))), 4*250000)
+        self.assertEqual(timer.shared_value, 16*100000 + 4*250000)
+
+        timer.stop_render(file=output)
+        self.assertTrue(re.findall('^Shared: 100%: ETA in: .* [0-9]+/s$', output.getvalue().splitlines()[-1]))
+
+    def test_track_tasks(self):
+        import simpletimer
+        import asyncio
+        import io
+        import random
+
+        output = io.StringIO()
+
+        async def fake_task(i):
+            await asyncio.sleep(random.random()*0.2)
+            return i
+
+        async def main():
+            results = []
+            tasks = [fake_task(i) for i in range(5000)]
+            async for result in simpletimer.track_tasks(tasks, 'Tasks', interval=0.02, file=output):
+                results.append(result)
+            return results
+
+        results = asyncio.run(main())
+        self.assertEqual(sorted(results), list(range(5000)))
+        lines = output.getvalue().splitlines()
+        self.assertTrue(1 < len(lines) < 50)
+        self.assertTrue(lines[-1].startswith('Tasks: 100%: ETA in'))
+
+        async def items():
+            for i in range(10):
+                await asyncio.sleep(0)
+                yield i
+
+        async def wrapped():
+            timer = simpletimer.ProgressTimer(10)
+            return [i async for i in timer.awrap(items(), file=output)], timer.count
+
+        self.assertEqual(asyncio.run(wrapped()), (list(range(10)), 10))
+
+        # Renders with a sampled estimator do not change the item count:
+        async def slow_items():
+            for i in range(100):
+                await asyncio.sleep(0.001)
+                yield i
+
+        for kwargs in [{'estimator': 'ewma'}, {'sample_size': 20}]:
+            output = io.StringIO()
+
+            async def sampled():
+                timer = simpletimer.ProgressTimer(100, 'Sampled', **kwargs)
+                return [i async for i in timer.awrap(slow_items(), interval=0.005, file=output)], timer.count
+
+            self.assertEqual(asyncio.run(sampled()), (list(range(100)), 100))
+            lines = output.getvalue().splitlines()
+            self.assertTrue(len(lines) > 1)
+            self.assertTrue(lines[-1].startswith('Sampled: 100%: ETA in'))
+
+    def test_Timers(self):
+        import simpletimer
+        import threading
+
+        timers = simpletimer.Timers()
+
+        @timers.timed()
+        def parse():
+            time.sleep(0.001)
+
+        def load():
+            with timers.section('load'):
+                for i in range(5):
+                    parse()
+                with timers.section('read'):
+                    time.sleep(0.002)
+
+        threads = [threading.Thread(target=load) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = timers.stats()
+        self.assertEqual(set(stats), {('load',), ('load', 'parse'), ('load', 'read')})
+        self.assertEqual(stats[('load',)].count, 4)
+        self.assertEqual(stats[('load', 'parse')].count, 20)
+        self.assertTrue(stats[('load', 'parse')].min >= 1000000)
+        self.assertTrue(stats[('load',)].total >= stats[('load', 'parse')].total + stats[('load', 'read')].total)
+
+        # Children are sorted within their parent, here from fixed timings:
+        fixture = simpletimer.Timers()
+        with fixture.section('load'):
+            for i in range(5):
+                fixture.record('parse', 1000000)
+            fixture.record('read', 2000000)
+        report = fixture.string().splitlines()
+        self.assertEqual([line.split()[0] for line in report[1:]], ['load', 'parse', 'read'])
+        self.assertTrue(report[2].startswith('  parse'))
+        report = fixture.string(sort='max').splitlines()
+        self.assertEqual([line.split()[0] for line in report[1:]], ['load', 'read', 'parse'])
+
+        timers.enabled = False
+        self.assertTrue(timers.section('load') is simpletimer._NULL_SECTION)
+        load()
+        self.assertEqual(timers.stats()[('load',)].count, 4)
+        timers.reset()
+        self.assertEqual(timers.stats(), {})
+
+    def test_LatencyHistogram(self):
+        import simpletimer
+        import json
+        import random
+
+        values = [random.randint(0, 10**9) for i in range(100000)]
+        first, second = simpletimer.LatencyHistogram(), simpletimer.LatencyHistogram()
+        for value in values[:50000]:
+            first.record(value)
+        for value in values[50000:]:
+            second.record(value)
+
+        first.merge(simpletimer.LatencyHistogram.from_dict(json.loads(json.dumps(second.to_dict()))))
+        self.assertEqual(first.count, 100000)
+        self.assertEqual(first.max, max(values))
+        self.assertTrue(len(first.counts) < 8*(65 - 7)*2**7)
+
+        values.sort()
+        for percent, value in first.percentiles().items():
+            exact = values[int(percent/100*len(values)) - 1]
+            self.assertTrue(abs(value - exact) <= exact*2**-7 + 1, (percent, value, exact))
+
+        # Small values are exact:
+        histogram = simpletimer.LatencyHistogram()
+        for value in range(1, 101):
+            histogram.record(value)
+        self.assertEqual(histogram.quantile(0.5), 50)
+        self.assertEqual(histogram.quantile(1), 100)
+
+        timers = simpletimer.Timers()
+        timer = simpletimer.SimpleTimer(histogram=simpletimer.LatencyHistogram())
+        for i in range(10):
+            with timers.section('step'):
+                time.sleep(0.001)
+            self.assertTrue(timer.lap() >= 0.001)
+            timers.record('stream', 1000*i)
+        self.assertEqual(timer.histogram.count, 10)
+        self.assertTrue(timers.percentiles('step')[50] >= 1000000)
+        self.assertTrue(abs(timers.percentiles('stream', (100,))[100] - 9000) <= 9000*2**-7)
+
+        other = simpletimer.Timers()
+        other.merge(timers.export())
+        other.merge(timers.export())
+        self.assertEqual(other.stats()[('step',)].count, 20)
+
+    def test_SlowIterationSampler(self):
+        import simpletimer
+        import logger
+
+        log = logger.Log()
+        timer = simpletimer.ProgressTimer(100000, 'Sampled')
+        sampler = simpletimer.SlowIterationSampler(timer, log, window=1.0)
+
+        # Windows are driven by hand with fixed times, sampling from inside the steps:
+        def fast_step():
+            sampler.sample()
+
+        def slow_step():
+            sampler.sample()
+
+        start = sampler._window_start
+        for second in range(1, 4):
+            fast_step()
+            timer.update(1000)
+            self.assertFalse(sampler.check(start + second))
+        self.assertEqual(sampler.baseline, 1000)
+        self.assertFalse(sampler.check(start + 3.5))
+
+        for i in range(10):
+            slow_step()
+        timer.update(100)
+        self.assertTrue(sampler.check(start + 4))
+
+        self.assertEqual(sampler.slow_windows, 1)
+        self.assertEqual(log.warningCount, 1)
+        warning = log.warnings()[0].text
+        self.assertTrue(warning[0].startswith('Slow iterations in Sampled: 100.0/s against a baseline of 1000.0/s'))
+        self.assertTrue(any('slow_step' in line for line in warning[1:]))
+        self.assertFalse(any('fast_step' in line for line in warning[1:]))
+
+        # The interval backs off under overhead and recovers:
+        sampler._adapt_interval(1.0)
+        sampler._adapt_interval(1.0)
+        self.assertEqual(sampler.interval, 4*sampler.base_interval)
+        sampler._adapt_interval(0.0)
+        sampler._adapt_interval(0.0)
+        sampler._adapt_interval(0.0)
+        self.assertEqual(sampler.interval, sampler.base_interval)
+
+        # Sampling from the background thread:
+        with timer.attach_sampler(log, interval=0.001, window=3600) as sampler:
+            while sampler.samples < 5:
+                time.sleep(0.001)
+        self.assertTrue(sampler.overhead > 0)
+
+    def test_ProgressDashboard(self):
+        import simpletimer
+        import io
+        import threading
+
+        class Terminal(io.StringIO):
+            def isatty(self):
+                return True
+
+        screen = Terminal()
+        dashboard = simpletimer.ProgressDashboard(fps=50, file=screen)
+
+        def job(timer):
+            for i in range(timer.total_count):
+                time.sleep(0.001)
+                timer.update()
+
+        with dashboard:
+            timers = [dashboard.add(100, 'Stage %d' % i) for i in range(3)]
+            threads = [threading.Thread(target=job, args=(timer,)) for timer in timers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        text = screen.getvalue()
+        self.assertTrue(dashboard.frames > 3)
+        # Every frame after the first moves back over the four lines of the previous one:
+        self.assertEqual(text.count('\x1b[4F'), dashboard.frames - 1)
+        last = text.split('\x1b[4F')[-1].split('\n')
+        self.assertTrue(last[0].startswith('3 jobs, 3 done'))
+        self.assertTrue(re.match(r'Stage 0 +100% +100/100 .* done in', last[1]))
+
+        # Not a terminal: only periodic plain summaries and the final frame.
+        log = io.StringIO()
+        dashboard = simpletimer.ProgressDashboard(fps=50, file=log, summary_interval=0.1)
+        with dashboard:
+            timer = dashboard.add(100, 'Plain')
+            job(timer)
+        text = log.getvalue()
+        self.assertTrue('\x1b' not in text)
+        self.assertTrue(text.count('1 jobs') == dashboard.frames >= 2)
+        self.assertTrue('done in' in text.splitlines()[-1])
+
+
+def _count_in_process(task):
+    import simpletimer
+
+    counter = simpletimer.progress_counter()
+    for i in range(250000):
+        counter.update()
+    counter.flush()
+    return 250000
+
+
 def run():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestSimpletimerModule)
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        test_tracer
+# Purpose:     Test the components of the tracer module.
+#-------------------------------------------------------------------------------
+import unittest
+import sys
+import os
+import json
+import tempfile
+import threading
+
+sys.path = [os.path.split(os.path.split(os.path.realpath(__file__))[0])[0] + os.path.sep] + sys.path
+
+
+class TestTracerModule(unittest.TestCase):
+    def test_tracer(self):
+        import tracer
+        import logger
+        import simpletimer
+
+        trace = tracer.Tracer(capacity=1000)
+        timers = simpletimer.Timers(tracer=trace)
+        progress = simpletimer.ProgressTimer(10, 'Steps', tracer=trace)
+        log = logger.Log(tracer=trace)
+
+        def work():
+            with timers.section('load'):
+                for i in range(10):
+                    with timers.section('parse'):
+                        pass
+                    progress.calculate()
+
+        threads = [threading.Thread(target=work, name='Worker %d' % i) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        log.addError('Failed')
+        log.addWarning('Careful')
+        log.addMessage('Not traced')
+
+        events = list(trace.events())
+        self.assertEqual(trace.size, 2*(1 + 10 + 10) + 2)
+        self.assertEqual(set(e['args']['name'] for e in events if e['ph'] == 'M'), {'Worker 0', 'Worker 1', 'MainThread'})
+        self.assertEqual(sum(1 for e in events if e['ph'] == 'X' and e['name'] == 'parse'), 20)
+        self.assertEqual(sum(1 for e in events if e['ph'] == 'C'), 20)
+        self.assertEqual([e['args']['text'] for e in events if e['ph'] == 'i'], ['Failed', 'Careful'])
+        self.assertEqual(len(set(e['tid'] for e in events if e['ph'] == 'X')), 2)
+
+        path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+        trace.write_chrome_trace(path)
+        with open(path) as f:
+            self.assertEqual(len(json.load(f)['traceEvents']), len(events))
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+        collapsed = dict(line.rsplit(' ', 1) for line in trace.collapsed().splitlines())
+        self.assertEqual(set(collapsed), {'load', 'load;parse'})
+
+        for i in range(1000):
+            trace.instant('Overflow')
+        self.assertEqual(trace.size, 1000)
+        self.assertEqual(trace.dropped, 2*(1 + 10 + 10) + 2)
+
+
+def run():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTracerModule)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
+if __name__ == '__main__':
+    run()
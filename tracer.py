@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        tracer
+# Purpose:     Compact recording of timing events, exported as Chrome Trace
+#              Event JSON (for Perfetto or chrome://tracing) or as collapsed
+#              stacks for flamegraph tools.
+#
+#              Timers sections and ProgressTimer updates from simpletimer, and
+#              errors and warnings from logger.Log, are recorded when a Tracer
+#              is passed to them with tracer=...
+#-------------------------------------------------------------------------------
+
+import json
+import threading
+import time
+from array import array
+
+# Event phases, as in the Chrome Trace Event format:
+COMPLETE = 0
+INSTANT = 1
+COUNTER = 2
+PHASES = ('X', 'i', 'C')
+
+
+class Tracer(object):
+    def __init__(self, capacity=1000000):
+        """Fixed capacity buffer of trace events. The columns are preallocated, so recording an event only stores a
+        few values, and memory does not grow after creation. Events recorded when the buffer is full are counted in
+        dropped and otherwise ignored.
+
+        Times are time.perf_counter_ns values. Each event belongs to the thread that recorded it, and every thread
+        gets its own track in the export.
+
+        capacity -- int, maximum number of events.
+        """
+        self.capacity = capacity
+        self.phases = array('b', bytes(capacity))
+        self.starts = array('q', bytes(8*capacity))
+        self.durations = array('q', bytes(8*capacity))
+        self.threads = array('q', bytes(8*capacity))
+        self.names = [None]*capacity
+        self.args = [None]*capacity
+        self.size = 0
+        self.dropped = 0
+        self.thread_names = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _add(self, phase, name, start, duration, args):
+        with self._lock:
+            index = self.size
+            if index >= self.capacity:
+                self.dropped += 1
+                return
+            self.size = index + 1
+        # Threads are numbered on their first event, since idents are reused after a thread ends:
+        try:
+            thread = self._local.thread
+        except AttributeError:
+            with self._lock:
+                thread = self._local.thread = len(self.thread_names) + 1
+                self.thread_names[thread] = threading.current_thread().name
+        self.phases[index] = phase
+        self.starts[index] = start
+        self.durations[index] = duration
+        self.threads[index] = thread
+        self.names[index] = name
+        self.args[index] = args
+
+    def complete(self, name, start, duration, stack=None):
+        """Record a timed section that started at start and lasted duration nanoseconds. stack is the tuple of
+        section names it is nested in, ending with name, used for the collapsed stack export."""
+        self._add(COMPLETE, name, start, duration, stack)
+
+    def instant(self, name, args=None):
+        """Record a point event, e.g. a logged error, with a dict of args."""
+        self._add(INSTANT, name, time.perf_counter_ns(), 0, args)
+
+    def counter(self, name, **values):
+        """Record the values of a counter track, e.g. progress."""
+        self._add(COUNTER, name, time.perf_counter_ns(), 0, values)
+
+    def clear(self):
+        """Forget all events."""
+        with self._lock:
+            self.size = 0
+            self.dropped = 0
+            for index in range(self.capacity):
+                self.names[index] = self.args[index] = None
+
+    def events(self):
+        """Yield the events as Chrome Trace Event dicts, times in microseconds from the first event."""
+        size = self.size
+        origin = min(self.starts[:size]) if size else 0
+        pid = 1
+        tids = {}
+        for thread, name in list(self.thread_names.items()):
+            tid = tids[thread] = len(tids) + 1
+            yield {'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+
+        for index in range(size):
+            phase = self.phases[index]
+            event = {'ph': PHASES[phase], 'name': self.names[index], 'pid': pid,
+                     'tid': tids.get(self.threads[index], 0), 'ts': (self.starts[index] - origin)/1000}
+            if phase == COMPLETE:
+                event['dur'] = self.durations[index]/1000
+            elif phase == INSTANT:
+                event['s'] = 't'
+                if self.args[index]:
+                    event['args'] = self.args[index]
+            else:
+                event['args'] = self.args[index]
+            yield event
+
+    def write_chrome_trace(self, path):
+        """Write the events as a Chrome Trace Event JSON file, one event at a time."""
+        with open(path, 'w') as f:
+            f.write('{"traceEvents": [\n')
+            first = True
+            for event in self.events():
+                if not first:
+                    f.write(',\n')
+                f.write(json.dumps(event))
+                first = False
+            f.write('\n], "displayTimeUnit": "ms", "otherData": %s}\n' % json.dumps({'dropped': self.dropped}))
+
+    def collapsed(self):
+        """Return the timed sections as collapsed stacks, 'outer;inner self_microseconds' per line, for flamegraph
+        tools. Self time is the time of a stack minus the time of the stacks directly under it."""
+        totals = {}
+        for index in range(self.size):
+            if self.phases[index] != COMPLETE:
+                continue
+            stack = self.args[index] or (self.names[index],)
+            totals[stack] = totals.get(stack, 0) + self.durations[index]
+
+        own = dict(totals)
+        for stack, total in totals.items():
+            if len(stack) > 1 and stack[:-1] in own:
+                own[stack[:-1]] -= total
+
+        return '\n'.join('%s %d' % (';'.join(stack), max(total, 0)//1000)
+                         for stack, total in sorted(own.items()))
+
+    def write_collapsed(self, path):
+        """Write the collapsed stacks to a file."""
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+            f.write('\n')